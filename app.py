@@ -1,54 +1,620 @@
 from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Response, stream_with_context, g, before_render_template, template_rendered
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timezone
 from contextlib import contextmanager
-import sqlite3, os, base64, math
+import sqlite3, os, base64, math, csv, secrets, zipfile
+import queue, threading, time, struct, hashlib, bisect, sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
+from collections import namedtuple, OrderedDict, Counter, deque
+import atexit
 import numpy as np
 from PIL import Image
 import io
 import json  # <-- TAMBAH INI
-
-# Try to import face recognition with fallback
-try:
-    import face_recognition
-    FACE_RECOGNITION_AVAILABLE = True
-    print("✅ Face recognition loaded successfully")
-except ImportError as e:
-    print(f"❌ Face recognition not available: {e}")
-    FACE_RECOGNITION_AVAILABLE = False
-    # Fallback: simple face detection using OpenCV
+# Kode yang jalan di process pool analisis wajah: modul terpisah tanpa efek samping saat
+# di-import, supaya worker spawn tidak ikut memuat app (migrasi, pool db, secret key, ...)
+from face_worker import (FACE_RECOGNITION_AVAILABLE, face_models, prepare_frame,
+                         verify_face_with_fallbacks, run_face_job, extract_descriptors_job,
+                         warm_up_face_models)
+
+def load_or_create_secret_key(path):
+    """Secret key acak yang dibuat sekali lalu disimpan: tetap antar restart & sama untuk semua worker"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secrets.token_hex(32))
     try:
-        import cv2
-        print("✅ Using OpenCV as fallback")
-    except ImportError:
-        print("❌ OpenCV also not available")
+        os.link(tmp_path, path)  # gagal kalau worker lain sudah membuat duluan
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+def default_face_workers():
+    """Budget CPU analisis wajah (cpu - 1) dibagi ke semua worker web.
+
+    Tiap worker gunicorn punya pool proses sendiri; WEB_CONCURRENCY diisi gunicorn.conf.py.
+    """
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY') or 1))
+    return max(1, ((os.cpu_count() or 2) - 1) // web_workers)
 
 app = Flask(__name__)
-app.secret_key = "face-recognition-secret-123"
+app.config['SECRET_KEY'] = None  # kosong -> dibuat sekali di instance/secret_key
 app.config['UPLOAD_FOLDER'] = "static/uploads"
 app.config['MAX_CONTENT_LENGTH'] = 15 * 1024 * 1024
+app.config['DATABASE'] = 'attendance.db'
+app.config['DB_POOL_SIZE'] = 8
+app.config['FACE_WORKERS'] = default_face_workers()  # 0 = analisis inline di thread request
+app.config['FACE_QUEUE_SIZE'] = 8
+app.config['FACE_JOB_TIMEOUT'] = 10
+app.config['FACE_WARMUP'] = False  # muat model wajah di semua worker saat boot
+app.config['CACHE_TTL'] = 30
+app.config['CACHE_MAX_ENTRIES'] = 256
+app.config['CHATBOT_MATCHER'] = 'jaccard'  # 'jaccard' atau 'tfidf' (lihat bench_chatbot.py)
+app.config['CHATBOT_LOG_BATCH'] = 100        # baris per transaksi write-behind
+app.config['CHATBOT_LOG_INTERVAL'] = 1.0     # detik maksimal pesan menunggu di buffer
+app.config['CHATBOT_LOG_MAX_PENDING'] = 1000
+app.config['CHATBOT_RETENTION_DAYS'] = 180   # 0 = simpan selamanya
+app.config['CHATBOT_MAX_PER_USER'] = 500     # 0 = tanpa batas
+app.config['METRICS_TOKEN'] = None  # bearer token scraper /metrics (tanpa token: hanya admin login)
+app.config['METRICS_ALLOWED_IPS'] = {'127.0.0.1', '::1'}  # cek tambahan untuk token; kosong = semua IP
+app.config['PROFILE_SLOW_REQUEST_MS'] = 0    # >0: sampling profiler untuk request selambat ini
+app.config['METRICS_DIR'] = None  # folder bersama antar worker pre-fork (diisi gunicorn.conf.py)
+# Zona presensi: lingkaran {latitude, longitude, radius_m} atau poligon {points: [[lat, lon], ...]}
+app.config['GEOFENCE_ZONES'] = [
+    {'name': 'MTs Nurul Huda', 'type': 'circle', 'latitude': -6.2088, 'longitude': 106.8456, 'radius_m': 100},
+]
+app.config['LATE_AFTER'] = '07:00'  # waktu masuk setelah jam ini = terlambat
+
+# Override dari environment, nilai dibaca sebagai JSON bila bisa:
+# PRESENSI_SECRET_KEY=..., PRESENSI_DATABASE=/data/attendance.db, PRESENSI_DB_POOL_SIZE=16, PRESENSI_FACE_WARMUP=true
+app.config.from_prefixed_env('PRESENSI')
+if not app.config['SECRET_KEY']:
+    app.config['SECRET_KEY'] = load_or_create_secret_key(os.path.join(app.instance_path, 'secret_key'))
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 # Create uploads folder if not exists
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
-SCHOOL_LOCATION = {'latitude': -6.2088, 'longitude': 106.8456}
-MAX_RADIUS_METERS = 100
-
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# ===== METRICS & PROFILING =====
+
+# Batas bucket histogram dalam detik (le= di format Prometheus)
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ProcessShare:
+    """Folder bersama antar proses worker (pre-fork), mirip multiprocess mode prometheus_client.
+
+    Tiap proses menulis snapshot JSON miliknya ({kind}_{pid}.json); pembaca menggabungkan
+    semua file. File proses yang sudah berhenti tetap dibaca supaya counter tidak mundur.
+    Tanpa directory semua operasi jadi no-op (satu proses, mis. python app.py).
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, kind, data):
+        if not self.directory:
+            return
+        path = self._path(f'{kind}_{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)  # pembaca tidak pernah melihat file setengah jadi
+
+    def read_others(self, kind):
+        """Snapshot semua proses lain untuk kind ini"""
+        if not self.directory:
+            return []
+        own = f'{kind}_{os.getpid()}.json'
+        snapshots = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(f'{kind}_') and name.endswith('.json') and name != own:
+                try:
+                    with open(self._path(name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return snapshots
+
+    def set_setting(self, name, value):
+        if self.directory:
+            tmp = self._path(f'{name}.setting.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp, self._path(f'{name}.setting'))
+
+    def get_setting(self, name, default=None):
+        if not self.directory:
+            return default
+        try:
+            with open(self._path(f'{name}.setting')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+process_share = ProcessShare(app.config['METRICS_DIR'])
+
+class Metrics:
+    """Histogram durasi per nama metrik + label, diekspor sebagai teks Prometheus.
+
+    Dengan process_share aktif, snapshot ditulis berkala (dump_interval) dan render()
+    menjumlahkan histogram semua worker, jadi scrape tidak bergantung worker yang menjawab.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS, share=None, dump_interval=5.0):
+        self.buckets = buckets
+        self.share = share or ProcessShare()
+        self.dump_interval = dump_interval
+        # (nama, label) -> [jumlah per bucket (+Inf di akhir)..., total detik]
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+            if self.share.directory and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name='metrics-dump', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(f"Metrics dump error: {e}")
+
+    def dump(self):
+        """Tulis snapshot histogram proses ini ke folder bersama"""
+        if self.share.directory:
+            self.share.write('metrics', self._snapshot())
+
+    def _snapshot(self):
+        with self._lock:
+            return [[name, [list(pair) for pair in labels], list(histogram)]
+                    for (name, labels), histogram in self._histograms.items()]
+
+    def reset(self):
+        """Buang histogram warisan proses induk (dipanggil setelah fork)"""
+        with self._lock:
+            self._histograms.clear()
+            self._thread = None
+
+    @contextmanager
+    def span(self, stage):
+        """Catat durasi satu tahap (db, face, chatbot, tulis file) ke app_stage_duration_seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('app_stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{Metrics._escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        merged = {}
+        for snapshot in [self._snapshot()] + self.share.read_others('metrics'):
+            for name, labels, histogram in snapshot:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = list(histogram)
+                elif len(total) == len(histogram):
+                    merged[key] = [a + b for a, b in zip(total, histogram)]
+        items = sorted(merged.items())
+
+        lines, current = [], None
+        for (name, labels), histogram in items:
+            if name != current:
+                lines.append(f'# TYPE {name} histogram')
+                current = name
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram[-1]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(share=process_share)
+
+class SlowRequestProfiler:
+    """Sampling profiler opsional: sampel stack thread request secara berkala, simpan
+    stack terpanas untuk request yang lebih lambat dari threshold_ms (0 = mati).
+    """
+
+    def __init__(self, threshold_ms=0, interval=0.005, keep=20, max_depth=40, share=None,
+                 setting_refresh=1.0):
+        # Threshold & laporan dibagi lewat folder bersama supaya semua worker ikut
+        self.share = share or ProcessShare()
+        self.threshold_ms = self.share.get_setting('profile_slow_request_ms', threshold_ms)
+        self.setting_refresh = setting_refresh
+        self._setting_checked = time.monotonic()
+        self.interval = interval
+        self.max_depth = max_depth
+        self._active = {}  # thread id -> Counter stack (format collapsed, siap flamegraph)
+        self._reports = deque(maxlen=keep)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def set_threshold(self, threshold_ms):
+        """Ubah threshold di semua worker (lewat folder bersama) atau proses ini saja"""
+        self.threshold_ms = threshold_ms
+        self.share.set_setting('profile_slow_request_ms', threshold_ms)
+
+    def _refresh_threshold(self):
+        now = time.monotonic()
+        if self.share.directory and now - self._setting_checked >= self.setting_refresh:
+            self._setting_checked = now
+            self.threshold_ms = self.share.get_setting('profile_slow_request_ms', self.threshold_ms)
+
+    def begin(self):
+        self._refresh_threshold()
+        if not self.enabled:
+            return
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self._thread.start()
+
+    def end(self, label, elapsed):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if samples is None or elapsed * 1000 < self.threshold_ms:
+            return
+        report = {
+            'request': label,
+            'duration_ms': round(elapsed * 1000, 1),
+            'samples': sum(samples.values()),
+            'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'pid': os.getpid(),
+            'hot_stacks': [{'stack': stack, 'samples': count} for stack, count in samples.most_common(10)],
+        }
+        with self._lock:
+            self._reports.append(report)
+            reports = list(self._reports)
+        try:
+            self.share.write('slow_requests', reports)
+        except OSError as e:
+            print(f"Profiler dump error: {e}")
+        if samples:
+            top_stack, top_count = samples.most_common(1)[0]
+            print(f"[SLOW] {label} {report['duration_ms']}ms, stack terpanas ({top_count}/{report['samples']}): "
+                  f"{';'.join(top_stack.split(';')[-3:])}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                thread_ids = list(self._active)
+                if not thread_ids:  # tidak ada request aktif: thread berhenti, begin() menyalakan lagi
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    samples = self._active.get(thread_id)
+                    if samples is not None:
+                        samples[';'.join(reversed(stack))] += 1
+
+    def reports(self):
+        """Laporan terbaru dari semua worker, urut waktu"""
+        with self._lock:
+            reports = list(self._reports)
+        for snapshot in self.share.read_others('slow_requests'):
+            reports.extend(snapshot)
+        reports.sort(key=lambda report: report['at'])
+        return reports[-self._reports.maxlen:]
+
+    def reset(self):
+        with self._lock:
+            self._active.clear()
+            self._reports.clear()
+            self._thread = None
+
+slow_request_profiler = SlowRequestProfiler(app.config['PROFILE_SLOW_REQUEST_MS'], share=process_share)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    slow_request_profiler.begin()
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(exc):
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    # Pakai pola route (/api/rekap), bukan path asli, supaya jumlah label tetap kecil
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    status = g.pop('response_status', 500)
+    metrics.observe('http_request_duration_seconds', elapsed,
+                    method=request.method, route=route, status=status)
+    slow_request_profiler.end(f"{request.method} {route}", elapsed)
+
+def _template_render_started(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+def _template_render_finished(sender, template, context, **extra):
+    start = g.pop('template_start', None)
+    if start is not None:
+        metrics.observe('app_stage_duration_seconds', time.perf_counter() - start, stage='render_template')
+
+before_render_template.connect(_template_render_started, app)
+template_rendered.connect(_template_render_finished, app)
+
+# ===== DATABASE CONNECTION POOL =====
+
+# WAL: pembaca (rekap/riwayat) tidak memblokir penulis (presensi) dan sebaliknya
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",      # aman untuk WAL, fsync hanya saat checkpoint
+    "PRAGMA cache_size = -16000",       # ~16 MB page cache per koneksi
+    "PRAGMA mmap_size = 67108864",      # 64 MB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+]
+
+class ConnectionPool:
+    """Pool koneksi SQLite yang dipakai ulang antar request (thread-safe)"""
+
+    def __init__(self, database, max_size=8, timeout=10.0, cached_statements=256):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'unpooled_opened': 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,  # cache prepared statement per koneksi
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                with self._lock:
+                    self._stats['connections_created'] += 1
+            else:
+                waited = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("Pool koneksi database penuh, coba lagi")
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time_ms'] += wait_ms
+                self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+        return conn
+
+    def connect_unpooled(self):
+        """Koneksi baca-saja di luar pool untuk pembaca lama (stream export).
+
+        Klien download yang lambat tidak menahan slot pool; pemanggil wajib close().
+        """
+        conn = self._connect()
+        conn.execute("PRAGMA query_only = ON")
+        with self._lock:
+            self._stats['unpooled_opened'] += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                discard = True
+        if discard:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+                self._stats['connections_discarded'] += 1
+        else:
+            self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['size'] = self._created
+        snapshot['idle'] = self._idle.qsize()
+        snapshot['in_use'] = snapshot['size'] - snapshot['idle']
+        snapshot['max_size'] = self.max_size
+        snapshot['wait_time_ms'] = round(snapshot['wait_time_ms'], 2)
+        snapshot['max_wait_ms'] = round(snapshot['max_wait_ms'], 2)
+        return snapshot
+
+db_pool = ConnectionPool(app.config['DATABASE'], max_size=app.config['DB_POOL_SIZE'])
+
 @contextmanager
 def db_connection():
-    conn = sqlite3.connect('attendance.db')
-    conn.row_factory = sqlite3.Row
+    start = time.perf_counter()
+    conn = db_pool.acquire()
+    acquired = time.perf_counter()
+    metrics.observe('app_stage_duration_seconds', acquired - start, stage='db_acquire')
     try:
         yield conn
     finally:
-        conn.close()
+        # Transaksi yang belum di-commit di-rollback sebelum koneksi kembali ke pool
+        db_pool.release(conn)
+        metrics.observe('app_stage_duration_seconds', time.perf_counter() - acquired, stage='db_connection')
+
+# ===== USER SESSION =====
+
+# Kolom yang tidak ikut disimpan di cache profil (rahasia / besar)
+PROFILE_EXCLUDED_COLUMNS = ('password', 'face_descriptors')
+
+def profile_version(row):
+    """Stempel versi profil: berubah saat password, role, atau status berubah.
+
+    Session lama otomatis tidak berlaku setelah ganti password / dinonaktifkan.
+    """
+    raw = f"{row['password']}|{row['role']}|{row['status']}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:12]
+
+def session_identity(row):
+    """Isi cookie session: cukup id, role, dan stempel versi (bukan seluruh baris users)"""
+    return {'id': row['id'], 'role': row['role'], 'version': profile_version(row)}
+
+class UserProfileCache:
+    """Cache profil user per proses supaya require_role & halaman tidak query users tiap request"""
+
+    def __init__(self, max_age=60.0, max_entries=1024):
+        # max_age: perubahan profil dari worker lain terlihat paling lambat sekian detik
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries = {}  # user_id -> (loaded_at, profil atau None)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, refresh=False):
+        """Profil dari cache; refresh=True selalu muat ulang dari database"""
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if not refresh and entry is not None and now - entry[0] <= self.max_age:
+            return entry[1]
+
+        generation = self._generation
+        with db_connection() as conn:
+            row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        profile = None
+        if row is not None:
+            profile = {k: row[k] for k in row.keys() if k not in PROFILE_EXCLUDED_COLUMNS}
+            profile['version'] = profile_version(row)
+        with self._lock:
+            if generation == self._generation:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[user_id] = (now, profile)
+        return profile
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+user_profiles = UserProfileCache()
+
+def current_user():
+    """Profil user yang login (dict dari cache, jangan diubah); None jika session tidak berlaku"""
+    if 'user' in g:
+        return g.user
+    identity = session.get('user') or {}
+    profile = None
+    if 'id' in identity:
+        profile = user_profiles.get(identity['id'])
+        if profile is None or profile['version'] != identity.get('version'):
+            # Cache bisa basi (profil diubah lewat worker lain): muat ulang sekali sebelum menolak
+            profile = user_profiles.get(identity['id'], refresh=True)
+    if profile is None or profile['version'] != identity.get('version'):
+        profile = None
+    g.user = profile
+    return profile
 
 def require_role(*roles):
     def decorator(f):
@@ -56,31 +622,165 @@ def require_role(*roles):
         def decorated_function(*args, **kwargs):
             if 'user' not in session:
                 return redirect(url_for('login'))
-            if session['user']['role'].upper() not in roles:
+            user = current_user()
+            if user is None:
+                # Cookie lama / password atau status user sudah berubah
+                session.clear()
+                return redirect(url_for('login'))
+            if user['role'].upper() not in roles:
                 flash("Akses ditolak", "danger")
                 return redirect(url_for('dashboard'))
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    from math import radians, sin, cos, sqrt, atan2
-    R = 6371000
-    try:
-        lat1_rad = radians(float(lat1))
-        lon1_rad = radians(float(lon1))
-        lat2_rad = radians(float(lat2))
-        lon2_rad = radians(float(lon2))
+# ===== GEOFENCE =====
 
-        dlat = lat2_rad - lat1_rad
-        dlon = lon2_rad - lon1_rad
+EARTH_RADIUS_M = 6371000.0
 
-        a = sin(dlat/2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Jarak (meter) antar titik derajat; semua argumen boleh array NumPy"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
 
-        return R * c
-    except (ValueError, TypeError):
-        return float('inf')
+def parse_coordinate(value):
+    """Koordinat dari form / kolom TEXT -> float, NaN jika kosong atau tidak valid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def minute_of_day(value):
+    """'HH:MM' -> menit sejak 00:00 (sama dengan kolom menit_masuk/menit_keluar)"""
+    hours, minutes = value.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+GeofenceResult = namedtuple('GeofenceResult', ['inside', 'zone', 'distance_m'])
+
+class Geofence:
+    """Zona presensi (lingkaran & poligon) dengan bounding box yang dihitung sekali.
+
+    check() memeriksa banyak titik sekaligus dengan NumPy: dipakai presensi (1 titik)
+    maupun audit riwayat presensi (semua baris dalam satu pass).
+    """
+
+    def __init__(self, zones):
+        self.names = []
+        self.circles = []   # (indeks zona, lat, lon, radius_m)
+        self.polygons = []  # (indeks zona, vertex (V, 2) lat/lon)
+        boxes = []          # per zona: lat_min, lat_max, lon_min, lon_max
+        for index, zone in enumerate(zones):
+            self.names.append(zone.get('name') or f'Zona {index + 1}')
+            if zone.get('type', 'circle') == 'polygon':
+                vertices = np.asarray(zone['points'], dtype=np.float64)
+                if vertices.ndim != 2 or vertices.shape[0] < 3 or vertices.shape[1] != 2:
+                    raise ValueError(f"Poligon {self.names[-1]} butuh minimal 3 titik [lat, lon]")
+                self.polygons.append((index, vertices))
+                boxes.append((vertices[:, 0].min(), vertices[:, 0].max(),
+                              vertices[:, 1].min(), vertices[:, 1].max()))
+            else:
+                lat, lon, radius = float(zone['latitude']), float(zone['longitude']), float(zone['radius_m'])
+                self.circles.append((index, lat, lon, radius))
+                dlat = math.degrees(radius / EARTH_RADIUS_M)
+                dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+                boxes.append((lat - dlat, lat + dlat, lon - dlon, lon + dlon))
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+    def centers(self):
+        """Titik tengah tiap zona (lat, lon) - untuk tampilan & data uji"""
+        centers = [None] * len(self.names)
+        for index, lat, lon, _ in self.circles:
+            centers[index] = (lat, lon)
+        for index, vertices in self.polygons:
+            centers[index] = tuple(vertices.mean(axis=0))
+        return centers
+
+    def check(self, latitudes, longitudes):
+        """Array inside (bool), zone (indeks zona pertama yang memuat titik, -1 jika tidak ada),
+        distance_m (0 di dalam zona, selain itu jarak ke tepi zona terdekat; inf jika koordinat invalid)
+        """
+        lat = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+        lon = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+        zone = np.full(len(lat), -1, dtype=np.int64)
+        distance = np.full(len(lat), np.inf)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        in_box = (valid[:, None]
+                  & (lat[:, None] >= self.boxes[:, 0]) & (lat[:, None] <= self.boxes[:, 1])
+                  & (lon[:, None] >= self.boxes[:, 2]) & (lon[:, None] <= self.boxes[:, 3]))
+
+        for index, c_lat, c_lon, radius in self.circles:
+            outside_m = np.full(len(lat), np.inf)
+            outside_m[valid] = haversine_m(lat[valid], lon[valid], c_lat, c_lon) - radius
+            self._merge(zone, distance, index, in_box[:, index] & (outside_m <= 0), outside_m)
+
+        for index, vertices in self.polygons:
+            inside = np.zeros(len(lat), dtype=bool)
+            candidates = np.nonzero(in_box[:, index])[0]  # ray casting hanya untuk titik di dalam bbox
+            if len(candidates):
+                inside[candidates] = self._in_polygon(lat[candidates], lon[candidates], vertices)
+            outside_m = np.full(len(lat), np.inf)
+            outside_m[valid] = self._polygon_edge_distance(lat[valid], lon[valid], vertices)
+            self._merge(zone, distance, index, inside, outside_m)
+
+        return GeofenceResult(zone >= 0, zone, distance)
+
+    @staticmethod
+    def _merge(zone, distance, index, inside, outside_m):
+        zone[inside & (zone < 0)] = index
+        np.minimum(distance, np.where(inside, 0.0, np.maximum(outside_m, 0.0)), out=distance)
+
+    @staticmethod
+    def _in_polygon(lat, lon, vertices):
+        """Ray casting (N titik x E sisi sekaligus); lon sebagai x, lat sebagai y"""
+        y1, x1 = vertices[:, 0], vertices[:, 1]
+        y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+        py, px = lat[:, None], lon[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+        return crosses.sum(axis=1) % 2 == 1
+
+    @staticmethod
+    def _polygon_edge_distance(lat, lon, vertices):
+        """Jarak (meter) titik ke sisi poligon terdekat, proyeksi equirectangular lokal"""
+        lat0 = math.radians(vertices[:, 0].mean())
+        scale = math.pi / 180 * EARTH_RADIUS_M
+        vy, vx = vertices[:, 0] * scale, vertices[:, 1] * scale * math.cos(lat0)
+        py, px = (lat * scale)[:, None], (lon * scale * math.cos(lat0))[:, None]
+        ex, ey = np.roll(vx, -1) - vx, np.roll(vy, -1) - vy
+        length2 = np.maximum(ex * ex + ey * ey, 1e-12)
+        t = np.clip(((px - vx) * ex + (py - vy) * ey) / length2, 0, 1)
+        return np.hypot(px - (vx + t * ex), py - (vy + t * ey)).min(axis=1)
+
+    def locate(self, latitude, longitude):
+        """Satu titik: (di dalam?, nama zona atau None, jarak ke zona terdekat dalam meter)"""
+        result = self.check([parse_coordinate(latitude)], [parse_coordinate(longitude)])
+        index = int(result.zone[0])
+        return bool(result.inside[0]), (self.names[index] if index >= 0 else None), float(result.distance_m[0])
+
+geofence = Geofence(app.config['GEOFENCE_ZONES'])
+
+def audit_attendance_locations(date_from=None, date_to=None):
+    """Validasi ulang lokasi presensi historis dalam satu pass (audit).
+
+    Return (rows, GeofenceResult); baris tanpa koordinat valid -> inside False, distance inf.
+    """
+    query = "SELECT id, user_id, date, latitude, longitude FROM attendance WHERE 1=1"
+    params = []
+    if date_from:
+        query += " AND date >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND date <= ?"
+        params.append(date_to)
+    query += " ORDER BY date, id"
+
+    with db_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    # Kolom REAL (migrasi 007): NULL -> NaN langsung di NumPy tanpa parsing string
+    latitudes = np.array([row['latitude'] for row in rows], dtype=np.float64)
+    longitudes = np.array([row['longitude'] for row in rows], dtype=np.float64)
+    return rows, geofence.check(latitudes, longitudes)
 
 def check_duplicate_attendance(user_id, date):
     with db_connection() as conn:
@@ -90,70 +790,517 @@ def check_duplicate_attendance(user_id, date):
         ).fetchone()
         return existing is not None
 
-def simple_face_detection(image_data):
-    """Simple face detection using OpenCV as fallback"""
-    try:
-        import cv2
+# ===== IMAGE PREPROCESSING =====
 
-        # Decode base64 image
-        img_data = base64.b64decode(image_data.split(',')[1])
-        nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Load face detector
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
-        # Detect faces
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-
-        return len(faces) > 0, len(faces)
-    except Exception as e:
-        print(f"Simple face detection error: {e}")
-        return False, 0
-
-def verify_face_with_fallbacks(user_id, image_data):
-    """Verify face with multiple fallback methods"""
-
-    # Method 1: Using face_recognition library
-    if FACE_RECOGNITION_AVAILABLE:
+def decode_image_data(image_data):
+    """Data URL base64 dari kamera -> bytes JPEG asli (cukup sekali per request)"""
+    try:
+        return base64.b64decode(image_data.split(',')[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+# ===== PHOTO STORAGE =====
+
+PHOTO_QUALITY = 82
+PHOTO_MAX_SIDE = 1280
+THUMBNAIL_SIZE = (160, 160)
+THUMBNAIL_DIR = 'thumbs'
+
+class PhotoStore:
+    """Simpan foto di background thread: kompres ulang, path content-addressed, thumbnail, fsync.
+
+    Nama file = sha256 isi foto, dibagi ke folder ab/cd/ supaya satu folder tidak berisi
+    ribuan file; foto yang sama persis hanya disimpan sekali.
+    """
+
+    def __init__(self, root, max_pending=64):
+        self.root = root
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'queued': 0, 'written': 0, 'deduplicated': 0, 'inline_writes': 0, 'errors': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='photo-store', daemon=True)
+                self._thread.start()
+
+    def save(self, image_bytes):
+        """Return nama file relatif terhadap UPLOAD_FOLDER; file ditulis di background"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        filename = f"{digest[:2]}/{digest[2:4]}/{digest}.jpg"
+        if os.path.exists(os.path.join(self.root, filename)):
+            self._count('deduplicated')
+            return filename
+
+        self._ensure_worker()
         try:
-            # Decode base64 image
-            img_data = base64.b64decode(image_data.split(',')[1])
-            image = face_recognition.load_image_file(io.BytesIO(img_data))
+            self._queue.put_nowait((filename, image_bytes))
+            self._count('queued')
+        except queue.Full:
+            # Antrian penuh: tulis langsung supaya foto tidak hilang
+            self._count('inline_writes')
+            self._write(filename, image_bytes)
+        return filename
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._count('errors')
+                print(f"Error saving image: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, filename, image_bytes):
+        with metrics.span('photo_write'):
+            self._write_files(filename, image_bytes)
+
+    def _write_files(self, filename, image_bytes):
+        path = os.path.join(self.root, filename)
+        if os.path.exists(path):
+            self._count('deduplicated')
+            return
 
-            # Get face encodings
-            face_encodings = face_recognition.face_encodings(image)
+        try:
+            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        except Exception:
+            # Bukan gambar yang bisa didecode: simpan apa adanya, tanpa thumbnail
+            self._atomic_write(path, lambda f: f.write(image_bytes))
+            return
+
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        self._atomic_write(path, lambda f: image.save(f, 'JPEG', quality=PHOTO_QUALITY, optimize=True))
+
+        thumb = image.copy()
+        thumb.thumbnail(THUMBNAIL_SIZE)
+        thumb_path = os.path.join(self.root, THUMBNAIL_DIR, filename)
+        self._atomic_write(thumb_path, lambda f: thumb.save(f, 'JPEG', quality=70, optimize=True))
+        self._count('written')
+
+    @staticmethod
+    def _atomic_write(path, writer):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            writer(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        """Tunggu semua foto di antrian selesai ditulis"""
+        self._queue.join()
+
+    def shutdown(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot['pending'] = self._queue.qsize()
+        return snapshot
+
+photo_store = PhotoStore(app.config['UPLOAD_FOLDER'])
+
+@app.template_filter('thumbnail')
+def thumbnail_filter(filename):
+    """Path thumbnail untuk foto content-addressed; file lama (flat) dipakai apa adanya"""
+    if filename and '/' in filename:
+        return f"{THUMBNAIL_DIR}/{filename}"
+    return filename
+
+# ===== FACE ANALYSIS WORKER POOL =====
+
+class FaceServiceBusy(Exception):
+    """Antrian analisis wajah penuh atau job melewati batas waktu"""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FaceAnalysisService:
+    """Jalankan decode + verify_face_with_fallbacks di process pool dengan antrian terbatas.
+
+    Deteksi wajah memakai CPU ratusan ms per gambar; di process terpisah semua core
+    terpakai dan thread request lain (dashboard, rekap) tidak ikut tertahan.
+    """
+
+    def __init__(self, workers, queue_size, timeout, warm_up=False):
+        self.workers = workers
+        self.timeout = timeout
+        self.warm_up = warm_up
+        self._worker_metrics = {}  # pid worker -> metrik FaceModelRegistry terakhir
+        # Slot = job yang sedang jalan + yang boleh antri; lebih dari itu ditolak (503)
+        self._slots = threading.BoundedSemaphore(max(1, workers + queue_size))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'rejected': 0, 'timeouts': 0, 'failures': 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: jangan fork proses server yang sudah punya banyak thread & koneksi db
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_up_face_models if self.warm_up else None,
+                )
+            return self._executor
+
+    def start(self):
+        """Nyalakan semua worker sekarang (warm start) supaya presensi pertama tidak lambat"""
+        if self.workers <= 0:
+            face_models.warm_up()
+            return
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(os.getpid)
+
+    def _reset_executor(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def verify(self, user_id, image_bytes):
+        with metrics.span('face_verify'):
+            return self._verify(user_id, image_bytes)
+
+    @staticmethod
+    def _observe_timings(timings):
+        for stage, seconds in timings.items():
+            metrics.observe('app_stage_duration_seconds', seconds, stage=stage)
+
+    def _verify(self, user_id, image_bytes):
+        if self.workers <= 0:
+            result, _, _, timings = run_face_job(user_id, image_bytes)
+            self._observe_timings(timings)
+            return result
+
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise FaceServiceBusy("Server sedang sibuk memproses presensi lain. Coba lagi sebentar.")
 
-            if len(face_encodings) > 0:
-                # For now, just return that a face was detected
-                # In a real system, you'd compare with reference photos
-                return True, 0.8, "Face detected (face_recognition)"
-            else:
-                return False, 0.0, "No face detected"
+        try:
+            future = self._get_executor().submit(run_face_job, user_id, image_bytes)
+        except Exception:
+            self._slots.release()
+            self._reset_executor()
+            raise
+        # Slot baru dilepas saat job benar-benar selesai, termasuk job yang sudah timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        self._count('submitted')
 
-        except Exception as e:
-            print(f"Face recognition error: {e}")
+        try:
+            result, pid, model_metrics, timings = future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            self._count('timeouts')
+            raise FaceServiceBusy("Verifikasi wajah terlalu lama. Coba lagi sebentar.")
+        except BrokenProcessPool:
+            self._count('failures')
+            self._reset_executor()
+            raise FaceServiceBusy("Layanan verifikasi wajah sedang dimulai ulang. Coba lagi.")
+
+        with self._lock:
+            self._worker_metrics[pid] = model_metrics
+        self._observe_timings(timings)
+        return result
+
+    def run_batch(self, fn, items):
+        """Jalankan fn(item) di worker pool untuk pekerjaan massal (import staf).
+
+        Yield (index, hasil, error) sesuai urutan selesai. Job massal menunggu slot (tidak
+        ditolak) dan paling banyak `workers` job sekaligus, jadi sisa slot antrian tetap
+        tersedia untuk presensi.
+        """
+        if self.workers <= 0:
+            for index, item in enumerate(items):
+                try:
+                    yield index, fn(item), None
+                except Exception as e:
+                    yield index, None, e
+            return
+
+        pending = {}
+        items = iter(enumerate(items))
+        while True:
+            while len(pending) < self.workers:
+                next_item = next(items, None)
+                if next_item is None:
+                    break
+                index, item = next_item
+                self._slots.acquire()
+                try:
+                    future = self._get_executor().submit(fn, item)
+                except Exception:
+                    self._slots.release()
+                    raise
+                future.add_done_callback(lambda _: self._slots.release())
+                pending[future] = index
+            if not pending:
+                return
+            done, _ = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    self._reset_executor()
+                yield index, (None if error else future.result()), error
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            worker_metrics = list(self._worker_metrics.values())
+        snapshot['workers'] = self.workers
+        if self.workers <= 0:
+            worker_metrics = [face_models.stats()]
+
+        # Gabungkan metrik model dari semua worker
+        models = {}
+        for metrics in worker_metrics:
+            for name, metric in metrics.items():
+                total = models.setdefault(name, {'load_ms': [], 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+                if metric['load_ms'] is not None:
+                    total['load_ms'].append(metric['load_ms'])
+                total['calls'] += metric['calls']
+                total['total_ms'] += metric['total_ms']
+                total['max_ms'] = max(total['max_ms'], metric['max_ms'])
+        for total in models.values():
+            total['avg_ms'] = round(total['total_ms'] / total['calls'], 2) if total['calls'] else None
+            total['total_ms'] = round(total['total_ms'], 2)
+            total['max_ms'] = round(total['max_ms'], 2)
+        snapshot['models'] = models
+        return snapshot
+
+face_service = FaceAnalysisService(
+    workers=app.config['FACE_WORKERS'],
+    queue_size=app.config['FACE_QUEUE_SIZE'],
+    timeout=app.config['FACE_JOB_TIMEOUT'],
+    warm_up=app.config['FACE_WARMUP'],
+)
+
+# ===== FACE DESCRIPTOR INDEX =====
+
+FACE_MATCH_THRESHOLD = 0.6
+FACE_IDENTIFY_MARGIN = 0.05  # selisih minimal dengan kandidat kedua pada mode kiosk (1:N)
+FACE_BURST_MAX_FRAMES = 10     # batas descriptor per request verifikasi burst
+FACE_BURST_MIN_CONSISTENCY = 0.6  # porsi frame burst yang harus cocok
+
+# Format BLOB descriptor: header 12 byte (magic, versi, dimensi, jumlah) + float32 little-endian
+DESCRIPTOR_MAGIC = b'FDSC'
+DESCRIPTOR_FORMAT_VERSION = 1
+DESCRIPTOR_HEADER = struct.Struct('<4sHHI')
+
+def encode_descriptors(descriptors):
+    """Pack list descriptor (n x dim) menjadi BLOB float32"""
+    matrix = np.asarray(descriptors, dtype='<f4')
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if matrix.ndim != 2 or matrix.size == 0:
+        raise ValueError("Format descriptor tidak valid")
+    count, dim = matrix.shape
+    header = DESCRIPTOR_HEADER.pack(DESCRIPTOR_MAGIC, DESCRIPTOR_FORMAT_VERSION, dim, count)
+    return header + matrix.tobytes()
+
+def decode_descriptors(raw):
+    """BLOB -> matriks float32 (count x dim) tanpa copy; TEXT JSON lama tetap didukung"""
+    if isinstance(raw, str):
+        return np.ascontiguousarray(json.loads(raw), dtype=np.float32)
+    magic, version, dim, count = DESCRIPTOR_HEADER.unpack_from(raw)
+    if magic != DESCRIPTOR_MAGIC or version != DESCRIPTOR_FORMAT_VERSION:
+        raise ValueError("Format BLOB descriptor tidak dikenal")
+    return np.frombuffer(raw, dtype='<f4', count=count * dim,
+                         offset=DESCRIPTOR_HEADER.size).reshape(count, dim)
+
+class FaceDescriptorIndex:
+    """Cache descriptor wajah sebagai matriks float32 di memori proses.
+
+    Per user (verifikasi 1:1) dan galeri gabungan semua user aktif (identifikasi 1:N kiosk).
+    """
+
+    GALLERY = None  # key cache untuk galeri gabungan
+
+    def __init__(self, max_age=60.0):
+        # max_age: batas umur cache galeri supaya worker lain ikut melihat training ulang.
+        # Cache per user divalidasi face_trained_at tiap akses, jadi langsung ikut berubah.
+        self.max_age = max_age
+        self._entries = {}  # key -> (loaded_at / face_trained_at, data); "belum training" tidak disimpan
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, key, loader):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[0] <= self.max_age:
+            return entry[1]
+
+        generation = self._generation
+        data = loader()
+        self._store(key, generation, now, data)
+        return data
+
+    def _store(self, key, generation, stamp, data):
+        with self._lock:
+            # Jangan simpan hasil load yang sudah basi karena invalidate() di tengah jalan.
+            # None (belum training) tidak di-cache supaya training di worker lain langsung terlihat.
+            if data is not None and generation == self._generation:
+                self._entries[key] = (stamp, data)
+
+    def _load_user(self, user_id):
+        with db_connection() as conn:
+            row = conn.execute(
+                "SELECT face_descriptors, face_trained_at FROM users WHERE id = ?",
+                (user_id,)
+            ).fetchone()
+        if not row or not row['face_descriptors']:
+            return None, None
+        matrix = decode_descriptors(row['face_descriptors'])
+        return row['face_trained_at'], matrix.reshape(len(matrix), -1)
 
-    # Method 2: Simple face detection with OpenCV
-    try:
-        face_detected, face_count = simple_face_detection(image_data)
-        if face_detected:
-            return True, 0.7, f"Face detected (OpenCV) - {face_count} faces"
+    def _load_gallery(self):
+        with db_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, name, face_descriptors FROM users
+                WHERE status = 'Aktif' AND face_descriptors IS NOT NULL
+                ORDER BY id
+            """).fetchall()
+
+        matrices, users, starts = [], [], []
+        offset = 0
+        for row in rows:
+            try:
+                matrix = decode_descriptors(row['face_descriptors'])
+            except ValueError:
+                continue
+            matrix = matrix.reshape(len(matrix), -1)
+            if len(matrix) == 0 or (matrices and matrix.shape[1] != matrices[0].shape[1]):
+                continue
+            matrices.append(matrix)
+            users.append({'id': row['id'], 'name': row['name']})
+            starts.append(offset)
+            offset += len(matrix)
+
+        if not matrices:
+            return None
+        matrix = np.ascontiguousarray(np.vstack(matrices), dtype=np.float32)
+        return {
+            'matrix': matrix,
+            'sq_norms': np.einsum('ij,ij->i', matrix, matrix),
+            'starts': np.asarray(starts, dtype=np.intp),  # baris pertama tiap user (berurutan)
+            'users': users,
+        }
+
+    def get(self, user_id):
+        """Matriks descriptor user, None jika belum training.
+
+        Cache dipakai hanya jika face_trained_at (lookup primary key) masih sama, jadi
+        training ulang / reset di worker lain langsung terlihat tanpa menunggu max_age.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            with db_connection() as conn:
+                row = conn.execute("SELECT face_trained_at FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is not None and row['face_trained_at'] is not None and row['face_trained_at'] == entry[0]:
+                return entry[1]
+
+        generation = self._generation
+        trained_at, matrix = self._load_user(user_id)
+        # Descriptor lama tanpa face_trained_at tidak bisa divalidasi: selalu dibaca ulang
+        if trained_at is not None:
+            self._store(user_id, generation, trained_at, matrix)
         else:
-            return False, 0.0, "No face detected (OpenCV)"
-    except Exception as e:
-        print(f"OpenCV face detection error: {e}")
+            with self._lock:
+                self._entries.pop(user_id, None)
+        return matrix
+
+    def distances(self, user_id, descriptor):
+        """Jarak euclidean descriptor ke semua descriptor tersimpan user (satu operasi numpy)"""
+        matrix = self.get(user_id)
+        if matrix is None:
+            return None
+        query = np.asarray(descriptor, dtype=np.float32).reshape(-1)
+        if query.shape[0] != matrix.shape[1]:
+            raise ValueError(f"Dimensi descriptor {query.shape[0]} tidak sesuai ({matrix.shape[1]})")
+        return np.linalg.norm(matrix - query, axis=1)
+
+    def frame_distances(self, user_id, descriptors):
+        """Jarak terdekat tiap frame (burst N descriptor) ke descriptor tersimpan user.
+
+        Satu perkalian matriks (N x 128) . (128 x M): |q|^2 + |m|^2 - 2 q.m
+        """
+        matrix = self.get(user_id)
+        if matrix is None:
+            return None
+        frames = np.asarray(descriptors, dtype=np.float32)
+        if frames.ndim != 2 or frames.shape[1] != matrix.shape[1]:
+            raise ValueError(f"Bentuk descriptor {frames.shape} tidak sesuai (N x {matrix.shape[1]})")
+        squared = (np.einsum('ij,ij->i', frames, frames)[:, None]
+                   + np.einsum('ij,ij->i', matrix, matrix)[None, :]
+                   - 2 * frames @ matrix.T)
+        return np.sqrt(np.maximum(squared, 0)).min(axis=1)
+
+    def identify(self, descriptor):
+        """Cari user aktif paling mirip (1:N) dengan satu perkalian matriks-vektor.
+
+        Return dict {'user', 'distance', 'runner_up_distance'} atau None jika galeri kosong.
+        """
+        gallery = self._cached(self.GALLERY, self._load_gallery)
+        if gallery is None:
+            return None
+        matrix = gallery['matrix']
+        query = np.asarray(descriptor, dtype=np.float32).reshape(-1)
+        if query.shape[0] != matrix.shape[1]:
+            raise ValueError(f"Dimensi descriptor {query.shape[0]} tidak sesuai ({matrix.shape[1]})")
+
+        # ||a - q||^2 = ||a||^2 - 2 a.q + ||q||^2
+        squared = gallery['sq_norms'] - 2.0 * (matrix @ query) + float(query @ query)
+        distances = np.sqrt(np.maximum(squared, 0.0))
+        per_user = np.minimum.reduceat(distances, gallery['starts'])
+
+        if len(per_user) > 1:
+            top = np.argpartition(per_user, 1)[:2]
+            best, runner_up = sorted(top, key=lambda i: per_user[i])
+            runner_up_distance = float(per_user[runner_up])
+        else:
+            best, runner_up_distance = 0, None
+        return {
+            'user': gallery['users'][best],
+            'distance': float(per_user[best]),
+            'runner_up_distance': runner_up_distance,
+        }
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+                self._entries.pop(self.GALLERY, None)
 
-    # Method 3: Basic validation - just check if image exists
-    try:
-        img_data = base64.b64decode(image_data.split(',')[1])
-        image = Image.open(io.BytesIO(img_data))
-        return True, 0.5, "Image validated (basic check)"
-    except:
-        return False, 0.0, "Invalid image"
+face_index = FaceDescriptorIndex()
 
 def calculate_similarity(text1, text2):
     """Hitung similarity antara dua text (sederhana)"""
@@ -168,55 +1315,228 @@ def calculate_similarity(text1, text2):
 
     return len(intersection) / len(union)
 
+# Fallback hardcoded untuk pattern umum, dicek berurutan dengan substring match
+CHATBOT_FALLBACK_RESPONSES = [
+    (pattern.split('|'), response) for pattern, response in [
+        ('hai|halo|hi|hello|hey', 'Halo! Ada yang bisa saya bantu? 😊'),
+        ('terima kasih|thanks|makasih', 'Sama-sama! Semoga harimu menyenangkan 🌟'),
+        ('baik|good|oke', 'Bagus! Ada yang bisa saya bantu?'),
+        ('apa kabar|how are you', 'Saya baik-baik saja, siap membantu Anda!'),
+        ('nama kamu|siapa kamu', 'Saya asisten virtual sistem presensi MTs Nurul Huda 🤖'),
+        ('help|bantuan|tolong', 'Saya bisa membantu dengan:\n• Presensi dan face recognition\n• Masalah teknis\n• Informasi sistem\n• Panduan penggunaan'),
+    ]
+]
+
+CHATBOT_DEFAULT_RESPONSE = {
+    'response': 'Maaf, saya belum paham pertanyaan itu. Coba tanya tentang:\n• Cara presensi\n• Face recognition\n• Reset password\n• Riwayat presensi\n• Fitur sistem',
+    'type': 'info',
+    'confidence': 0.0
+}
+
+class KnowledgeMatcher:
+    """Knowledge base chatbot yang sudah dikompilasi: token set per pattern + inverted index.
+
+    Skor sama dengan calculate_similarity (Jaccard kata), tapi hanya pattern yang
+    berbagi minimal satu kata dengan pesan yang dihitung.
+    """
+
+    threshold = 0.4  # skor minimal supaya jawaban knowledge dipakai
+
+    def __init__(self, knowledge_items):
+        self.answers = []  # pattern id -> jawaban
+        self.sizes = []    # pattern id -> jumlah kata unik pattern
+        self.index = {}    # kata -> [pattern id]
+        # knowledge_items sudah urut priority DESC; pattern id mengikuti urutan itu
+        for pattern, answer in knowledge_items:
+            for p in pattern.split('|'):
+                tokens = set(p.split())
+                if not tokens:
+                    continue
+                pattern_id = len(self.sizes)
+                self.answers.append(answer)
+                self.sizes.append(len(tokens))
+                for token in tokens:
+                    self.index.setdefault(token, []).append(pattern_id)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def best_match(self, message):
+        """Kembalikan (jawaban, skor) pattern paling mirip, atau (None, 0.0)"""
+        words = set(message.split())
+        overlap = {}
+        for word in words:
+            for pattern_id in self.index.get(word, ()):
+                overlap[pattern_id] = overlap.get(pattern_id, 0) + 1
+
+        best_id, best_score = None, 0.0
+        for pattern_id, shared in overlap.items():
+            score = shared / (len(words) + self.sizes[pattern_id] - shared)
+            # Skor sama -> pattern dengan priority lebih tinggi (id lebih kecil) menang
+            if score > best_score or (score == best_score and pattern_id < best_id):
+                best_id, best_score = pattern_id, score
+
+        if best_id is None:
+            return None, 0.0
+        return self.answers[best_id], best_score
+
+def tfidf_features(text):
+    """Fitur TF-IDF: kata utuh + trigram karakter per kata (tahan typo/imbuhan)"""
+    features = []
+    for word in text.split():
+        features.append(word)
+        padded = f' {word} '
+        features.extend('#' + padded[i:i + 3] for i in range(len(padded) - 2))
+    return features
+
+class TfidfKnowledgeMatcher:
+    """Knowledge base chatbot sebagai matriks TF-IDF sparse (CSC) yang sudah dinormalisasi.
+
+    Skor = cosine similarity; satu pesan dinilai terhadap semua pattern dengan satu
+    perkalian matriks-vektor sparse (np.bincount atas kolom fitur pesan).
+    """
+
+    threshold = 0.5
+
+    def __init__(self, knowledge_items):
+        self.answers = []
+        documents = []
+        for pattern, answer in knowledge_items:
+            for p in pattern.split('|'):
+                features = tfidf_features(p)
+                if not features:
+                    continue
+                self.answers.append(answer)
+                documents.append(features)
+
+        self.vocabulary = {}
+        for features in documents:
+            for feature in features:
+                self.vocabulary.setdefault(feature, len(self.vocabulary))
+
+        # COO (pattern, fitur, tf) -> bobot tf-idf dengan idf ter-smoothing
+        rows, cols, counts = [], [], []
+        for row, features in enumerate(documents):
+            tf = {}
+            for feature in features:
+                col = self.vocabulary[feature]
+                tf[col] = tf.get(col, 0) + 1
+            rows.extend([row] * len(tf))
+            cols.extend(tf.keys())
+            counts.extend(tf.values())
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        counts = np.asarray(counts, dtype=np.float32)
+
+        n = len(documents)
+        df = np.bincount(cols, minlength=len(self.vocabulary)).astype(np.float32)
+        self.idf = np.log((1 + n) / (1 + df)).astype(np.float32) + 1
+        self.unknown_idf = float(np.log(1 + n)) + 1  # fitur pesan yang tidak ada di pattern
+        weights = counts * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=n))
+        weights = (weights / norms[rows]).astype(np.float32)
+
+        # Simpan per kolom supaya query cukup mengambil kolom fitur yang muncul
+        order = np.argsort(cols, kind='stable')
+        self.col_rows = rows[order]
+        self.col_weights = weights[order]
+        self.col_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=len(self.vocabulary)), out=self.col_ptr[1:])
+
+    def __len__(self):
+        return len(self.answers)
+
+    def scores(self, message):
+        """Cosine similarity pesan terhadap setiap pattern (array float32)"""
+        tf = {}
+        for feature in tfidf_features(message):
+            tf[feature] = tf.get(feature, 0) + 1
+        if not tf or not self.answers:
+            return np.zeros(len(self.answers), dtype=np.float32)
+
+        cols, query, norm = [], [], 0.0
+        for feature, count in tf.items():
+            col = self.vocabulary.get(feature)
+            weight = count * (self.idf[col] if col is not None else self.unknown_idf)
+            norm += weight * weight
+            if col is not None:
+                cols.append(col)
+                query.append(weight)
+        if not cols:
+            return np.zeros(len(self.answers), dtype=np.float32)
+
+        starts, ends = self.col_ptr[cols], self.col_ptr[np.asarray(cols) + 1]
+        lengths = ends - starts
+        idx = np.repeat(ends - lengths.cumsum(), lengths) + np.arange(lengths.sum())
+        values = self.col_weights[idx] * np.repeat(np.asarray(query, dtype=np.float32), lengths)
+        dots = np.bincount(self.col_rows[idx], weights=values, minlength=len(self.answers))
+        return (dots / math.sqrt(norm)).astype(np.float32)
+
+    def best_match(self, message):
+        scores = self.scores(message)
+        if not len(scores):
+            return None, 0.0
+        best = int(np.argmax(scores))  # skor sama -> priority lebih tinggi (indeks kecil)
+        if scores[best] <= 0:
+            return None, 0.0
+        return self.answers[best], float(scores[best])
+
+CHATBOT_MATCHERS = {
+    'jaccard': KnowledgeMatcher,
+    'tfidf': TfidfKnowledgeMatcher,
+}
+
+class ChatbotKnowledgeCache:
+    """Simpan KnowledgeMatcher per proses; dibangun ulang saat knowledge berubah"""
+
+    def __init__(self, max_age=60.0):
+        # max_age: supaya worker lain ikut melihat knowledge baru dari proses lain
+        self.max_age = max_age
+        self._entry = None  # (loaded_at, matcher)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, conn):
+        now = time.monotonic()
+        entry = self._entry
+        if entry is not None and now - entry[0] <= self.max_age:
+            return entry[1]
+
+        generation = self._generation
+        rows = conn.execute('''
+            SELECT question_pattern, answer
+            FROM chatbot_knowledge
+            WHERE is_active = TRUE
+            ORDER BY priority DESC
+        ''').fetchall()
+        matcher = CHATBOT_MATCHERS[app.config['CHATBOT_MATCHER']](rows)
+        with self._lock:
+            if generation == self._generation:
+                self._entry = (now, matcher)
+        return matcher
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entry = None
+
+chatbot_knowledge_cache = ChatbotKnowledgeCache()
+
 def find_best_response(conn, user_message):
     """Cari jawaban terbaik dari knowledge base"""
 
-    # Default response jika tidak ditemukan
-    default_response = {
-        'response': 'Maaf, saya belum paham pertanyaan itu. Coba tanya tentang:\n• Cara presensi\n• Face recognition\n• Reset password\n• Riwayat presensi\n• Fitur sistem',
-        'type': 'info',
-        'confidence': 0.0
-    }
-
     # Cari pattern yang match di knowledge base
-    knowledge_items = conn.execute('''
-        SELECT question_pattern, answer, category, priority 
-        FROM chatbot_knowledge 
-        WHERE is_active = TRUE
-        ORDER BY priority DESC
-    ''').fetchall()
-
-    best_match = None
-    highest_score = 0
-
-    for pattern, answer, category, priority in knowledge_items:
-        patterns = pattern.split('|')
-        for p in patterns:
-            score = calculate_similarity(user_message, p)
-            if score > highest_score and score > 0.3:  # Threshold similarity
-                highest_score = score
-                best_match = {
-                    'response': answer,
-                    'type': 'success' if score > 0.7 else 'info',
-                    'confidence': round(score, 2)
-                }
-
-    # Jika ada match yang cukup baik
-    if best_match and highest_score > 0.4:
-        return best_match
+    matcher = chatbot_knowledge_cache.get(conn)
+    answer, score = matcher.best_match(user_message)
+    if answer is not None and score > matcher.threshold:
+        return {
+            'response': answer,
+            'type': 'success' if score > 0.7 else 'info',
+            'confidence': round(score, 2)
+        }
 
     # Fallback ke hardcoded responses untuk pattern umum
-    fallback_responses = {
-        'hai|halo|hi|hello|hey': 'Halo! Ada yang bisa saya bantu? 😊',
-        'terima kasih|thanks|makasih': 'Sama-sama! Semoga harimu menyenangkan 🌟',
-        'baik|good|oke': 'Bagus! Ada yang bisa saya bantu?',
-        'apa kabar|how are you': 'Saya baik-baik saja, siap membantu Anda!',
-        'nama kamu|siapa kamu': 'Saya asisten virtual sistem presensi MTs Nurul Huda 🤖',
-        'help|bantuan|tolong': 'Saya bisa membantu dengan:\n• Presensi dan face recognition\n• Masalah teknis\n• Informasi sistem\n• Panduan penggunaan'
-    }
-
-    for pattern, response in fallback_responses.items():
-        patterns = pattern.split('|')
+    for patterns, response in CHATBOT_FALLBACK_RESPONSES:
         for p in patterns:
             if p in user_message:
                 return {
@@ -225,136 +1545,840 @@ def find_best_response(conn, user_message):
                     'confidence': 0.8
                 }
 
-    return default_response
+    return dict(CHATBOT_DEFAULT_RESPONSE)
+
+class ConversationLog:
+    """Write-behind log percakapan chatbot: baris dikumpulkan lalu ditulis per batch.
+
+    Satu transaksi (satu fsync) per batch, bukan per pesan, supaya tidak berebut lock
+    tulis dengan presensi. Buffer dibatasi; kalau penuh, baris ditulis langsung.
+    Database sibuk: batch disimpan dan dicoba ulang dengan backoff. Baris yang melanggar
+    constraint (mis. user sudah dihapus) dilewati satu per satu, bukan seluruh batch.
+    """
+
+    def __init__(self, batch_size=100, interval=1.0, max_pending=1000,
+                 retention_days=0, max_per_user=0, compact_every=6 * 3600, max_backoff=30.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retention_days = retention_days
+        self.max_per_user = max_per_user
+        self.compact_every = compact_every
+        self.max_backoff = max_backoff
+        self._retry = []  # baris yang belum tertulis karena database sibuk (ditulis lebih dulu)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._pending = threading.Event()    # dibangunkan record(); antrean hanya diambil di bawah _write_lock
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # ambil + tulis satu batch atomik: id mengikuti urutan pesan masuk
+        self._last_compact = time.monotonic()
+        self._stats = {'queued': 0, 'written': 0, 'batches': 0, 'inline_writes': 0,
+                       'errors': 0, 'retries': 0, 'dropped': 0, 'compacted': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._stopping.is_set():
+                return
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chatbot-log', daemon=True)
+                self._thread.start()
+
+    def record(self, user_id, user_message, bot_response):
+        # Waktu dicatat saat pesan masuk (UTC, format CURRENT_TIMESTAMP), bukan saat ditulis
+        row = (user_id, user_message, bot_response,
+               datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        self._ensure_worker()
+        try:
+            if self._stopping.is_set():
+                raise queue.Full
+            self._queue.put_nowait(row)
+            self._count('queued')
+            self._pending.set()
+        except queue.Full:
+            # Buffer penuh atau sedang shutdown: tulis langsung supaya pesan tidak hilang,
+            # setelah isi antrean supaya urutan tetap terjaga
+            self._count('inline_writes')
+            with self._write_lock:
+                self._write_all_queued()
+                if self._retry:
+                    self._retry.append(row)
+                else:
+                    self._retry = self._write_batch([row])
+
+    def _drain(self):
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        backoff = self.interval
+        while not self._stopping.is_set():
+            woken = self._pending.wait(timeout=self.interval)
+            try:
+                if woken or self._retry:
+                    self._pending.clear()
+                    # Beri waktu pesan lain ikut masuk batch yang sama
+                    time.sleep(min(self.interval, 0.05))
+                    with self._write_lock:
+                        self._write_all_queued()
+                if self._retry:
+                    # Database masih sibuk: tunggu makin lama sebelum mencoba lagi
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                else:
+                    backoff = self.interval
+                self._maybe_compact()
+            except Exception as e:
+                self._count('errors')
+                print(f"Chatbot log error: {e}")
+
+    def _write(self, rows):
+        if not rows:
+            return
+        with metrics.span('chatbot_log_write'), db_connection() as conn:
+            conn.executemany(
+                "INSERT INTO chatbot_conversations (user_id, user_message, bot_response, created_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+        self._count('written', len(rows))
+        self._count('batches')
 
-def init_db():
-    with db_connection() as conn:
-        cur = conn.cursor()
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT CHECK(role IN ('ADMIN','GURU','KARYAWAN','KEPALA SEKOLAH')),
-                nip TEXT,
-                jabatan TEXT,
-                status TEXT DEFAULT 'Aktif',
-                photo_profile TEXT,
-                photo_ref1 TEXT,
-                photo_ref2 TEXT,
-                face_descriptors TEXT,
-                face_trained_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''')
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS attendance (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                date TEXT NOT NULL,
-                waktu_masuk TEXT,
-                waktu_keluar TEXT,
-                status TEXT,
-                keterangan TEXT,
-                latitude TEXT,
-                longitude TEXT,
-                image_filename TEXT,
-                face_confidence REAL DEFAULT 0,
-                face_verified BOOLEAN DEFAULT FALSE,
-                verification_method TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                UNIQUE(user_id, date)
-            )''')
-
-        # Tabel untuk chatbot conversations
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS chatbot_conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_message TEXT NOT NULL,
-                bot_response TEXT NOT NULL,
-                message_type TEXT DEFAULT 'general',
-                confidence_score REAL DEFAULT 1.0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(id)
+    def _write_batch(self, rows):
+        """Tulis satu batch; return baris yang belum tertulis karena database sibuk"""
+        try:
+            self._write(rows)
+            return []
+        except sqlite3.OperationalError as e:
+            self._count('retries')
+            print(f"Chatbot log: database sibuk, {len(rows)} baris dicoba ulang ({e})")
+            return rows
+        except sqlite3.Error:
+            pass  # ada baris yang ditolak constraint: tulis satu per satu di bawah
+
+        for i, row in enumerate(rows):
+            try:
+                self._write([row])
+            except sqlite3.OperationalError:
+                self._count('retries')
+                return rows[i:]
+            except sqlite3.Error as e:
+                self._count('dropped')
+                print(f"Chatbot log: baris user {row[0]} dilewati ({e})")
+        return []
+
+    def _write_all_queued(self):
+        """Tulis batch yang tertunda lalu isi antrean per batch; pemanggil memegang _write_lock"""
+        while True:
+            rows = self._retry or self._drain()
+            self._retry = []
+            if not rows:
+                break
+            self._retry = self._write_batch(rows)
+            if self._retry:
+                break
+
+    def flush(self):
+        """Tulis semua baris yang masih di buffer (dipanggil sebelum membaca/menghapus history).
+
+        Thread writer hanya mengambil antrean sambil memegang _write_lock, jadi setelah lock
+        didapat tidak ada batch lain yang sedang di tengah jalan.
+        """
+        with self._write_lock:
+            self._write_all_queued()
+
+    def _maybe_compact(self):
+        if time.monotonic() - self._last_compact < self.compact_every:
+            return
+        self._last_compact = time.monotonic()
+        with db_connection() as conn:
+            self._count('compacted', compact_chatbot_conversations(
+                conn, self.retention_days, self.max_per_user))
+
+    def shutdown(self):
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        if self._retry:
+            print(f"Chatbot log: {len(self._retry)} baris tidak tertulis saat shutdown (database sibuk)")
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot['retry_pending'] = len(self._retry)
+        snapshot['pending'] = self._queue.qsize()
+        return snapshot
+
+def compact_chatbot_conversations(conn, retention_days, max_per_user):
+    """Hapus percakapan lebih tua dari retention_days dan lebih dari max_per_user per user.
+
+    Return jumlah baris yang dihapus. Nilai 0 mematikan aturan yang bersangkutan.
+    """
+    deleted = 0
+    if retention_days:
+        deleted += conn.execute(
+            "DELETE FROM chatbot_conversations WHERE created_at < datetime('now', ?)",
+            (f'-{int(retention_days)} days',)
+        ).rowcount
+    if max_per_user:
+        deleted += conn.execute('''
+            DELETE FROM chatbot_conversations WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY user_id ORDER BY created_at DESC, id DESC
+                    ) AS rn
+                    FROM chatbot_conversations
+                ) WHERE rn > ?
             )
-        ''')
-
-        # Tabel untuk chatbot knowledge base
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS chatbot_knowledge (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                question_pattern TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                category TEXT DEFAULT 'general',
-                tags TEXT,
-                priority INTEGER DEFAULT 1,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ''', (max_per_user,)).rowcount
+    conn.commit()
+    return deleted
+
+chatbot_log = ConversationLog(
+    batch_size=app.config['CHATBOT_LOG_BATCH'],
+    interval=app.config['CHATBOT_LOG_INTERVAL'],
+    max_pending=app.config['CHATBOT_LOG_MAX_PENDING'],
+    retention_days=app.config['CHATBOT_RETENTION_DAYS'],
+    max_per_user=app.config['CHATBOT_MAX_PER_USER'],
+)
+
+# ===== BULK STAFF IMPORT =====
+
+STAFF_ROLES = ('ADMIN', 'GURU', 'KARYAWAN', 'KEPALA SEKOLAH')
+STAFF_IMPORT_REQUIRED = ('name', 'email', 'password', 'role')
+STAFF_PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+class PhotoSource:
+    """Foto referensi dari folder atau file zip, dicari per nama file (tanpa memperhatikan folder)"""
+
+    def __init__(self, source):
+        self._zip = None
+        self._files = {}
+        if isinstance(source, str) and os.path.isdir(source):
+            for root, _, names in os.walk(source):
+                for name in names:
+                    self._files[name.lower()] = os.path.join(root, name)
+        else:
+            self._zip = zipfile.ZipFile(source)
+            for info in self._zip.infolist():
+                if not info.is_dir():
+                    self._files[os.path.basename(info.filename).lower()] = info
+
+    def find(self, *candidates):
+        """Bytes foto untuk nama file pertama yang ada (nama persis atau stem + ekstensi gambar)"""
+        for candidate in candidates:
+            if not candidate:
+                continue
+            candidate = candidate.strip().lower()
+            names = [candidate] + [candidate + ext for ext in STAFF_PHOTO_EXTENSIONS]
+            for name in names:
+                entry = self._files.get(name)
+                if entry is None:
+                    continue
+                if self._zip is not None:
+                    return self._zip.read(entry)
+                with open(entry, 'rb') as f:
+                    return f.read()
+        return None
+
+def parse_staff_csv(text):
+    """Baris CSV (header: name,email,password,role,nip,jabatan,status,photo) -> (baris valid, error)"""
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))
+    rows, errors, seen = [], [], set()
+    for line, raw in enumerate(reader, start=2):
+        row = {k.strip().lower(): (v or '').strip() for k, v in raw.items() if k}
+        row['role'] = row.get('role', '').upper()
+        row['email'] = row.get('email', '').lower()
+        missing = [column for column in STAFF_IMPORT_REQUIRED if not row.get(column)]
+        if missing:
+            errors.append({'line': line, 'email': row['email'], 'message': f"Kolom kosong: {', '.join(missing)}"})
+        elif row['role'] not in STAFF_ROLES:
+            errors.append({'line': line, 'email': row['email'], 'message': f"Role tidak dikenal: {row['role']}"})
+        elif row['email'] in seen:
+            errors.append({'line': line, 'email': row['email'], 'message': 'Email dobel di file CSV'})
+        else:
+            seen.add(row['email'])
+            row['line'] = line
+            rows.append(row)
+    return rows, errors
+
+def import_staff(csv_text, photos=None, hash_workers=None):
+    """Import staf massal; generator progres per baris (dict), item terakhir = ringkasan.
+
+    Password di-hash paralel (scrypt melepas GIL), descriptor wajah diekstrak di worker
+    pool face_service, lalu semua user di-insert dalam satu transaksi.
+    """
+    rows, errors = parse_staff_csv(csv_text)
+    for error in errors:
+        yield dict(error, status='error')
+
+    with db_connection() as conn:
+        existing = {r[0].lower() for r in conn.execute("SELECT email FROM users")}
+    valid = []
+    for row in rows:
+        if row['email'] in existing:
+            errors.append(row)
+            yield {'line': row['line'], 'email': row['email'], 'status': 'error', 'message': 'Email sudah terdaftar'}
+        else:
+            valid.append(row)
+
+    # Hash password paralel di thread pool
+    with ThreadPoolExecutor(max_workers=hash_workers or os.cpu_count() or 2) as executor:
+        hashes = list(executor.map(generate_password_hash, [row['password'] for row in valid]))
+    for row, hashed in zip(valid, hashes):
+        row['hashed'] = hashed
+
+    # Foto referensi -> simpan (PhotoStore) + ekstrak descriptor di worker pool
+    images = []
+    for row in valid:
+        image_bytes = photos.find(row.get('photo'), row.get('nip'), row['email']) if photos else None
+        row['photo_ref1'] = photo_store.save(image_bytes) if image_bytes else None
+        row['face_descriptors'] = None
+        row['face'] = 'tanpa foto'
+        if image_bytes:
+            images.append((row, image_bytes))
+
+    results = face_service.run_batch(extract_descriptors_job, [image for _, image in images])
+    for index, descriptors, error in results:
+        row = images[index][0]
+        if error is not None:
+            row['face'] = f'gagal: {error}'
+        elif descriptors is None:
+            row['face'] = 'foto disimpan, training lewat browser'
+        elif not descriptors:
+            row['face'] = 'wajah tidak terdeteksi'
+        else:
+            row['face_descriptors'] = encode_descriptors(descriptors)
+            row['face'] = 'descriptor tersimpan'
+        yield {'line': row['line'], 'email': row['email'], 'status': 'ready', 'face': row['face']}
+
+    # Satu transaksi untuk semua user valid
+    inserted = 0
+    if valid:
+        with db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("""
+                    INSERT INTO users (name, email, password, role, nip, jabatan, status,
+                                       photo_ref1, face_descriptors, face_trained_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CASE WHEN ? IS NULL THEN NULL ELSE CURRENT_TIMESTAMP END)
+                """, [
+                    (row['name'], row['email'], row['hashed'], row['role'], row.get('nip', ''),
+                     row.get('jabatan', ''), row.get('status') or 'Aktif', row['photo_ref1'],
+                     row['face_descriptors'], row['face_descriptors'])
+                    for row in valid
+                ])
+                conn.commit()
+                inserted = len(valid)
+            except sqlite3.Error as e:
+                conn.rollback()
+                yield {'status': 'done', 'inserted': 0, 'errors': len(errors) + len(valid),
+                       'message': f'Import dibatalkan, tidak ada user yang disimpan: {e}'}
+                return
+        response_cache.invalidate(CACHE_REKAP_NAMA_LIST, CACHE_KELOLA_GURU)
+        face_index.invalidate()
+        for row in valid:
+            yield {'line': row['line'], 'email': row['email'], 'status': 'ok', 'face': row['face']}
+
+    yield {
+        'status': 'done',
+        'inserted': inserted,
+        'errors': len(errors),
+        'with_descriptors': sum(1 for row in valid if row['face_descriptors']),
+    }
+
+# ===== DATABASE MIGRATIONS =====
+
+def table_columns(cur, table):
+    return {row[1] for row in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def add_missing_columns(cur, table, columns):
+    """Tambah kolom yang belum ada (pengganti ALTER TABLE manual di update_db.py)"""
+    existing = table_columns(cur, table)
+    for name, definition in columns:
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+def migration_001_base_schema(cur):
+    """Tabel utama: users, attendance, chatbot"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT CHECK(role IN ('ADMIN','GURU','KARYAWAN','KEPALA SEKOLAH')),
+            nip TEXT,
+            jabatan TEXT,
+            status TEXT DEFAULT 'Aktif',
+            photo_profile TEXT,
+            photo_ref1 TEXT,
+            photo_ref2 TEXT,
+            face_descriptors TEXT,
+            face_trained_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            waktu_masuk TEXT,
+            waktu_keluar TEXT,
+            status TEXT,
+            keterangan TEXT,
+            latitude TEXT,
+            longitude TEXT,
+            image_filename TEXT,
+            face_confidence REAL DEFAULT 0,
+            face_verified BOOLEAN DEFAULT FALSE,
+            verification_method TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            UNIQUE(user_id, date)
+        )''')
+
+    # Tabel untuk chatbot conversations
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS chatbot_conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_message TEXT NOT NULL,
+            bot_response TEXT NOT NULL,
+            message_type TEXT DEFAULT 'general',
+            confidence_score REAL DEFAULT 1.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # Tabel untuk chatbot knowledge base
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS chatbot_knowledge (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question_pattern TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            category TEXT DEFAULT 'general',
+            tags TEXT,
+            priority INTEGER DEFAULT 1,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migration_002_legacy_columns(cur):
+    """Lengkapi kolom pada database lama yang dibuat sebelum face recognition"""
+    add_missing_columns(cur, 'users', [
+        ('photo_profile', 'TEXT'),
+        ('photo_ref1', 'TEXT'),
+        ('photo_ref2', 'TEXT'),
+        ('face_descriptors', 'TEXT'),
+        ('face_trained_at', 'TIMESTAMP'),
+    ])
+    add_missing_columns(cur, 'attendance', [
+        ('face_confidence', 'REAL DEFAULT 0'),
+        ('face_verified', 'BOOLEAN DEFAULT FALSE'),
+        ('verification_method', 'TEXT'),
+    ])
+
+def migration_003_seed_data(cur):
+    """Admin default dan knowledge base chatbot"""
+    cur.execute("SELECT COUNT(*) FROM users WHERE role = 'ADMIN'")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO users (name, email, password, role, status) VALUES (?, ?, ?, ?, ?)",
+                    ("Admin", "admin@example.com", generate_password_hash("admin123"), "ADMIN", "Aktif"))
+
+    # Insert default knowledge data
+    cur.execute("SELECT COUNT(*) FROM chatbot_knowledge")
+    if cur.fetchone()[0] == 0:
+        default_knowledge = [
+            # Presensi questions
+            ("cara presensi|bagaimana presensi|presensi bagaimana", 
+             "Untuk melakukan presensi:\n1. Buka menu 'Presensi'\n2. Pastikan GPS aktif\n3. Nyalakan kamera\n4. Ambil foto wajah\n5. Submit presensi", 
+             "presensi", "cara,presensi,tutorial"),
+
+            ("face recognition|verifikasi wajah|wajah tidak terdeteksi", 
+             "Sistem menggunakan face recognition untuk keamanan. Pastikan:\n- Wajah terlihat jelas\n- Pencahayaan cukup\n- Tidak menggunakan masker\n- Background netral", 
+             "teknologi", "face recognition,wajah,verifikasi"),
+
+            ("radius presensi|jarak presensi|gps tidak bekerja", 
+             "Presensi hanya bisa dilakukan dalam radius 100 meter dari sekolah. Pastikan:\n- GPS smartphone aktif\n- Izin lokasi diberikan\n- Koneksi internet stabil", 
+             "presensi", "gps,radius,lokasi"),
+
+            ("lupa password|reset password|ganti password", 
+             "Untuk reset password:\n1. Login sebagai admin\n2. Buka menu 'Kelola Guru' \n3. Pilih user yang ingin direset\n4. Klik 'Reset Password'", 
+             "akun", "password,login,akun"),
+
+            ("riwayat presensi|lihat presensi|history presensi", 
+             "Untuk melihat riwayat presensi:\n1. Buka menu 'Riwayat'\n2. Pilih bulan yang diinginkan\n3. Lihat data presensi Anda", 
+             "presensi", "riwayat,history,data"),
+
+            ("rekap presensi|data presensi|laporan presensi", 
+             "Untuk melihat rekap presensi (Admin/Kepala Sekolah):\n1. Buka menu 'Rekap'\n2. Filter berdasarkan nama/tanggal\n3. Lihat data rekap lengkap", 
+             "admin", "rekap,laporan,data"),
+
+            ("login error|tidak bisa login|gagal login", 
+             "Jika mengalami masalah login:\n1. Periksa email dan password\n2. Pastikan akun masih aktif\n3. Hubungi admin jika lupa password\n4. Clear cache browser jika perlu", 
+             "akun", "login,error,masalah"),
+
+            ("fitur sistem|apa saja fitur|kemampuan sistem", 
+             "Fitur sistem presensi:\n✅ Presensi dengan face recognition\n✅ Verifikasi GPS real-time\n✅ Riwayat dan rekap presensi\n✅ Management user\n✅ Chatbot assistance", 
+             "sistem", "fitur,kemampuan,sistem"),
+
+            ("admin|peran admin|hak akses admin", 
+             "Peran Admin memiliki akses:\n- Kelola data guru/karyawan\n- Lihat rekap semua presensi\n- Reset password user\n- Management sistem", 
+             "admin", "admin,peran,akses"),
+
+            ("guru|peran guru|hak akses guru", 
+             "Peran Guru memiliki akses:\n- Presensi harian\n- Lihat riwayat pribadi\n- Update profil\n- Chatbot assistance", 
+             "user", "guru,peran,akses")
+        ]
+
+        for question, answer, category, tags in default_knowledge:
+            cur.execute(
+                "INSERT INTO chatbot_knowledge (question_pattern, answer, category, tags) VALUES (?, ?, ?, ?)",
+                (question, answer, category, tags)
             )
-        ''')
-
-        cur.execute("SELECT COUNT(*) FROM users WHERE role = 'ADMIN'")
-        if cur.fetchone()[0] == 0:
-            cur.execute("INSERT INTO users (name, email, password, role, status) VALUES (?, ?, ?, ?, ?)",
-                        ("Admin", "admin@example.com", generate_password_hash("admin123"), "ADMIN", "Aktif"))
-
-        # Insert default knowledge data
-        cur.execute("SELECT COUNT(*) FROM chatbot_knowledge")
-        if cur.fetchone()[0] == 0:
-            default_knowledge = [
-                # Presensi questions
-                ("cara presensi|bagaimana presensi|presensi bagaimana", 
-                 "Untuk melakukan presensi:\n1. Buka menu 'Presensi'\n2. Pastikan GPS aktif\n3. Nyalakan kamera\n4. Ambil foto wajah\n5. Submit presensi", 
-                 "presensi", "cara,presensi,tutorial"),
-
-                ("face recognition|verifikasi wajah|wajah tidak terdeteksi", 
-                 "Sistem menggunakan face recognition untuk keamanan. Pastikan:\n- Wajah terlihat jelas\n- Pencahayaan cukup\n- Tidak menggunakan masker\n- Background netral", 
-                 "teknologi", "face recognition,wajah,verifikasi"),
-
-                ("radius presensi|jarak presensi|gps tidak bekerja", 
-                 "Presensi hanya bisa dilakukan dalam radius 100 meter dari sekolah. Pastikan:\n- GPS smartphone aktif\n- Izin lokasi diberikan\n- Koneksi internet stabil", 
-                 "presensi", "gps,radius,lokasi"),
-
-                ("lupa password|reset password|ganti password", 
-                 "Untuk reset password:\n1. Login sebagai admin\n2. Buka menu 'Kelola Guru' \n3. Pilih user yang ingin direset\n4. Klik 'Reset Password'", 
-                 "akun", "password,login,akun"),
-
-                ("riwayat presensi|lihat presensi|history presensi", 
-                 "Untuk melihat riwayat presensi:\n1. Buka menu 'Riwayat'\n2. Pilih bulan yang diinginkan\n3. Lihat data presensi Anda", 
-                 "presensi", "riwayat,history,data"),
-
-                ("rekap presensi|data presensi|laporan presensi", 
-                 "Untuk melihat rekap presensi (Admin/Kepala Sekolah):\n1. Buka menu 'Rekap'\n2. Filter berdasarkan nama/tanggal\n3. Lihat data rekap lengkap", 
-                 "admin", "rekap,laporan,data"),
-
-                ("login error|tidak bisa login|gagal login", 
-                 "Jika mengalami masalah login:\n1. Periksa email dan password\n2. Pastikan akun masih aktif\n3. Hubungi admin jika lupa password\n4. Clear cache browser jika perlu", 
-                 "akun", "login,error,masalah"),
-
-                ("fitur sistem|apa saja fitur|kemampuan sistem", 
-                 "Fitur sistem presensi:\n✅ Presensi dengan face recognition\n✅ Verifikasi GPS real-time\n✅ Riwayat dan rekap presensi\n✅ Management user\n✅ Chatbot assistance", 
-                 "sistem", "fitur,kemampuan,sistem"),
-
-                ("admin|peran admin|hak akses admin", 
-                 "Peran Admin memiliki akses:\n- Kelola data guru/karyawan\n- Lihat rekap semua presensi\n- Reset password user\n- Management sistem", 
-                 "admin", "admin,peran,akses"),
-
-                ("guru|peran guru|hak akses guru", 
-                 "Peran Guru memiliki akses:\n- Presensi harian\n- Lihat riwayat pribadi\n- Update profil\n- Chatbot assistance", 
-                 "user", "guru,peran,akses")
-            ]
 
-            for question, answer, category, tags in default_knowledge:
+def migration_004_binary_descriptors(cur):
+    """Konversi face_descriptors JSON (TEXT) ke BLOB float32"""
+    rows = cur.execute(
+        "SELECT id, face_descriptors FROM users WHERE typeof(face_descriptors) = 'text'"
+    ).fetchall()
+    for user_id, raw in rows:
+        try:
+            blob = encode_descriptors(json.loads(raw))
+        except ValueError:
+            # Data rusak: kosongkan supaya user training ulang
+            blob = None
+        cur.execute("UPDATE users SET face_descriptors = ? WHERE id = ?", (blob, user_id))
+
+def summary_trigger_body(row, sign):
+    """Upsert ke tiga tabel ringkasan untuk satu baris attendance (row: NEW/OLD, sign: + atau -)"""
+    return f'''
+        INSERT INTO attendance_daily_summary (date, status, count)
+        VALUES ({row}.date, COALESCE({row}.status, ''), {sign}1)
+        ON CONFLICT(date, status) DO UPDATE SET count = count {sign} 1;
+
+        INSERT INTO attendance_monthly_user_summary (user_id, month, status, count)
+        VALUES ({row}.user_id, substr({row}.date, 1, 7), COALESCE({row}.status, ''), {sign}1)
+        ON CONFLICT(user_id, month, status) DO UPDATE SET count = count {sign} 1;
+
+        INSERT INTO attendance_status_summary (status, count)
+        VALUES (COALESCE({row}.status, ''), {sign}1)
+        ON CONFLICT(status) DO UPDATE SET count = count {sign} 1;
+    '''
+
+def create_summary_triggers(cur):
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS attendance_summary_insert AFTER INSERT ON attendance
+        BEGIN {summary_trigger_body('NEW', '+')} END''')
+
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS attendance_summary_delete AFTER DELETE ON attendance
+        BEGIN {summary_trigger_body('OLD', '-')} END''')
+
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS attendance_summary_update
+        AFTER UPDATE OF user_id, date, status ON attendance
+        BEGIN {summary_trigger_body('OLD', '-')} {summary_trigger_body('NEW', '+')} END''')
+
+def migration_005_summary_tables(cur):
+    """Tabel ringkasan presensi per hari, per user per bulan, dan per status (dijaga trigger)"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_daily_summary (
+            date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, status)
+        )''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_monthly_user_summary (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, status)
+        )''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_status_summary (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )''')
+
+    create_summary_triggers(cur)
+
+    # Isi awal dari data presensi yang sudah ada
+    cur.execute('''
+        INSERT INTO attendance_daily_summary (date, status, count)
+        SELECT date, COALESCE(status, ''), COUNT(*) FROM attendance
+        GROUP BY date, COALESCE(status, '')''')
+    cur.execute('''
+        INSERT INTO attendance_monthly_user_summary (user_id, month, status, count)
+        SELECT user_id, substr(date, 1, 7), COALESCE(status, ''), COUNT(*) FROM attendance
+        GROUP BY user_id, substr(date, 1, 7), COALESCE(status, '')''')
+    cur.execute('''
+        INSERT INTO attendance_status_summary (status, count)
+        SELECT COALESCE(status, ''), COUNT(*) FROM attendance
+        GROUP BY COALESCE(status, '')''')
+
+def has_index_on(cur, table, columns):
+    """Cek apakah sudah ada index (termasuk UNIQUE otomatis) dengan kolom awal = columns"""
+    for index in cur.execute(f"PRAGMA index_list({table})").fetchall():
+        indexed = [row[2] for row in cur.execute(f"PRAGMA index_info('{index[1]}')").fetchall()]
+        if indexed[:len(columns)] == list(columns):
+            return True
+    return False
+
+def migration_006_query_indexes(cur):
+    """Index untuk query dashboard, riwayat, rekap, kelola guru dan history chatbot"""
+    # Database lama tidak punya UNIQUE(user_id, date) - buat index biasa sebagai gantinya
+    if not has_index_on(cur, 'attendance', ['user_id', 'date']):
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_date_status ON attendance(date, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_role_name ON users(role, name)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users(name)")
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_chatbot_conversations_user_created
+                   ON chatbot_conversations(user_id, created_at)""")
+
+def minute_of_day_sql(column):
+    """'HH:MM[:SS]' -> menit sejak 00:00 (NULL jika tidak ada ':'), sebagai ekspresi SQL"""
+    return f"""CASE WHEN instr({column}, ':') > 0
+        THEN CAST(substr({column}, 1, instr({column}, ':') - 1) AS INTEGER) * 60
+             + CAST(substr({column}, instr({column}, ':') + 1, 2) AS INTEGER) END"""
+
+def real_sql(column):
+    """Koordinat TEXT lama -> REAL; string kosong / bukan angka -> NULL (bukan 0)"""
+    return f"""CASE WHEN typeof({column}) IN ('real', 'integer') THEN {column}
+        WHEN trim({column}) GLOB '*[0-9]*' AND trim({column}) NOT GLOB '*[^0-9.+-]*'
+        THEN CAST(trim({column}) AS REAL) END"""
+
+def migration_007_typed_attendance(cur):
+    """attendance: koordinat REAL, menit masuk/keluar (INTEGER) dan tahun/bulan sebagai generated column.
+
+    SQLite tidak bisa mengubah tipe kolom, jadi tabel dibangun ulang (create - copy - drop - rename).
+    waktu_masuk/waktu_keluar tetap TEXT 'HH:MM' untuk tampilan; kolom menit dihitung SQLite sendiri.
+    """
+    # Database lama bisa berisi presensi dobel per hari: UNIQUE hanya jika datanya memungkinkan
+    duplicates = cur.execute(
+        "SELECT 1 FROM attendance GROUP BY user_id, date HAVING COUNT(*) > 1 LIMIT 1"
+    ).fetchone()
+    unique = '' if duplicates else ',\n            UNIQUE(user_id, date)'
+    sequence = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'attendance'").fetchone()
+
+    cur.execute(f'''
+        CREATE TABLE attendance_typed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            waktu_masuk TEXT,
+            waktu_keluar TEXT,
+            status TEXT,
+            keterangan TEXT,
+            latitude REAL,
+            longitude REAL,
+            image_filename TEXT,
+            face_confidence REAL DEFAULT 0,
+            face_verified BOOLEAN DEFAULT FALSE,
+            verification_method TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            menit_masuk INTEGER GENERATED ALWAYS AS ({minute_of_day_sql('waktu_masuk')}) STORED,
+            menit_keluar INTEGER GENERATED ALWAYS AS ({minute_of_day_sql('waktu_keluar')}) STORED,
+            tahun INTEGER GENERATED ALWAYS AS (CAST(substr(date, 1, 4) AS INTEGER)) VIRTUAL,
+            bulan INTEGER GENERATED ALWAYS AS (CAST(substr(date, 6, 2) AS INTEGER)) VIRTUAL,
+            FOREIGN KEY(user_id) REFERENCES users(id){unique}
+        )''')
+
+    cur.execute(f'''
+        INSERT INTO attendance_typed
+            (id, user_id, date, waktu_masuk, waktu_keluar, status, keterangan, latitude, longitude,
+             image_filename, face_confidence, face_verified, verification_method, created_at)
+        SELECT id, user_id, date, waktu_masuk, waktu_keluar, status, keterangan,
+               {real_sql('latitude')}, {real_sql('longitude')},
+               image_filename, face_confidence, face_verified, verification_method, created_at
+        FROM attendance''')
+
+    # DROP ikut menghapus index & trigger ringkasan; tabel ringkasan sendiri tidak berubah
+    cur.execute("DROP TABLE attendance")
+    cur.execute("ALTER TABLE attendance_typed RENAME TO attendance")
+    if sequence:
+        cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'attendance'", (sequence[0],))
+
+    create_summary_triggers(cur)
+    if duplicates:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_date_status ON attendance(date, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_year_month ON attendance(tahun, bulan)")
+
+# (versi, deskripsi, fungsi) - tambahkan migrasi baru di akhir, jangan ubah yang lama
+MIGRATIONS = [
+    (1, 'base schema', migration_001_base_schema),
+    (2, 'legacy columns (update_db.py)', migration_002_legacy_columns),
+    (3, 'seed admin & chatbot knowledge', migration_003_seed_data),
+    (4, 'face descriptors JSON -> float32 BLOB', migration_004_binary_descriptors),
+    (5, 'attendance summary tables + triggers', migration_005_summary_tables),
+    (6, 'indexes for dashboard/riwayat/rekap/chatbot queries', migration_006_query_indexes),
+    (7, 'typed attendance columns (REAL coordinates, minute-of-day, year/month)', migration_007_typed_attendance),
+]
+
+def init_db():
+    """Jalankan migrasi yang belum diterapkan. Dipanggil sekali saat startup, bukan per request."""
+    with db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+        conn.commit()
+
+        # Rebuild tabel (migrasi 007) butuh foreign key nonaktif; pragma ini tidak berlaku di dalam transaksi
+        conn.execute("PRAGMA foreign_keys = OFF")
+        # BEGIN IMMEDIATE supaya beberapa worker yang start bersamaan tidak migrasi dobel
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.cursor()
+            current = cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            for version, description, migrate in MIGRATIONS:
+                if version <= current:
+                    continue
+                migrate(cur)
                 cur.execute(
-                    "INSERT INTO chatbot_knowledge (question_pattern, answer, category, tags) VALUES (?, ?, ?, ?)",
-                    (question, answer, category, tags)
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
                 )
+                print(f"Migrasi {version:03d} diterapkan: {description}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute("PRAGMA foreign_keys = ON")
+
+def month_bounds(bulan):
+    """'YYYY-MM' -> (awal bulan, awal bulan berikutnya) untuk filter range yang bisa pakai index"""
+    start = datetime.strptime(bulan, '%Y-%m')
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+# ===== PAGINATION =====
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(values):
+    """Nilai kunci baris terakhir -> token cursor (base64 url-safe)"""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token, types):
+    """Token cursor -> list nilai kunci; None jika kosong, ValueError jika rusak.
+
+    types: tipe tiap nilai kunci, mis. (str, int) - panjang dan tipe harus sama persis
+    """
+    if not token:
+        return None
+    values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    if (not isinstance(values, list) or len(values) != len(types)
+            or any(isinstance(value, bool) or not isinstance(value, kind)
+                   for value, kind in zip(values, types))):
+        raise ValueError("Cursor tidak valid")
+    return values
+
+def page_size_arg():
+    size = request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int) or DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def fetch_page(conn, query, params, page_size, key):
+    """Ambil page_size baris (+1 untuk cek halaman berikutnya); key(row) -> nilai cursor"""
+    rows = conn.execute(query, params).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = encode_cursor(key(rows[-1])) if has_more else None
+    return rows, next_cursor
+
+# ===== RESPONSE CACHE =====
+
+class TTLCache:
+    """Cache kecil di memori proses: entri kedaluwarsa setelah ttl detik, LRU jika penuh"""
+
+    def __init__(self, ttl=30.0, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_or_set(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+
+        value = loader()
+        with self._lock:
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            if not keys:
+                self._data.clear()
+            for key in keys:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['entries'] = len(self._data)
+        return snapshot
+
+response_cache = TTLCache(ttl=app.config['CACHE_TTL'], max_entries=app.config['CACHE_MAX_ENTRIES'])
+
+# Key cache data bersama (sama untuk semua user)
+CACHE_DASHBOARD_CHART = 'dashboard_chart'
+CACHE_REKAP_NAMA_LIST = 'rekap_nama_list'
+CACHE_KELOLA_GURU = 'kelola_guru'
+
+def load_dashboard_chart():
+    with db_connection() as conn:
+        chart_data = conn.execute("""
+            SELECT date, SUM(count) as count FROM attendance_daily_summary 
+            WHERE date >= date('now', '-6 days') 
+            GROUP BY date HAVING SUM(count) > 0 ORDER BY date
+        """).fetchall()
+    return [row['date'] for row in chart_data], [row['count'] for row in chart_data]
 
-        conn.commit()
+def load_rekap_nama_list():
+    with db_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT name FROM users WHERE role IN ('GURU', 'KARYAWAN') ORDER BY name").fetchall()]
+
+def load_kelola_guru():
+    with db_connection() as conn:
+        return conn.execute("SELECT * FROM users WHERE role = 'GURU' ORDER BY name").fetchall()
 
 # ===== ROUTES =====
 
@@ -370,7 +2394,8 @@ def login():
         with db_connection() as conn:
             user = conn.execute("SELECT * FROM users WHERE email = ? AND status = 'Aktif'", (email,)).fetchone()
             if user and check_password_hash(user['password'], password):
-                session['user'] = dict(user)
+                session['user'] = session_identity(user)
+                user_profiles.invalidate(user['id'])
                 flash("Login berhasil!", "success")
                 return redirect(url_for('dashboard'))
             flash("Email atau password salah", "danger")
@@ -393,6 +2418,7 @@ def signup():
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 """, (data['name'], data['email'], hashed, data['role'], data['nip'], data['jabatan'], data['status'] or 'Aktif'))
                 conn.commit()
+                response_cache.invalidate(CACHE_REKAP_NAMA_LIST, CACHE_KELOLA_GURU)
                 flash("Pendaftaran berhasil! Silakan login.", "success")
                 return redirect(url_for('login'))
 
@@ -406,17 +2432,10 @@ def signup():
 @app.route('/dashboard')
 @require_role('ADMIN', 'GURU', 'KARYAWAN', 'KEPALA SEKOLAH')
 def dashboard():
-    user = session['user']
-    with db_connection() as conn:
-        chart_data = conn.execute("""
-            SELECT date, COUNT(*) as count FROM attendance 
-            WHERE date >= date('now', '-6 days') 
-            GROUP BY date ORDER BY date
-        """).fetchall()
-
-        labels = [row['date'] for row in chart_data]
-        counts = [row['count'] for row in chart_data]
+    user = current_user()
+    labels, counts = response_cache.get_or_set(CACHE_DASHBOARD_CHART, load_dashboard_chart)
 
+    with db_connection() as conn:
         if user['role'] in ['GURU', 'KARYAWAN']:
             riwayat = conn.execute("""
                 SELECT date, waktu_masuk, waktu_keluar, status, keterangan 
@@ -445,12 +2464,7 @@ def presensi():
             ).fetchone()
 
     # Cek training status untuk frontend
-    with db_connection() as conn:
-        training_status = conn.execute(
-            "SELECT face_descriptors FROM users WHERE id = ?", 
-            (user_id,)
-        ).fetchone()
-        is_trained = training_status and training_status['face_descriptors'] is not None
+    is_trained = face_index.get(user_id) is not None
 
     if request.method == 'POST':
         if sudah_absen:
@@ -474,27 +2488,26 @@ def presensi():
                 flash("Data tidak lengkap", "danger")
                 return redirect(url_for('presensi'))
 
-            # Validasi GPS
-            if latitude and longitude:
-                try:
-                    distance = calculate_distance(
-                        float(latitude), float(longitude),
-                        SCHOOL_LOCATION['latitude'], SCHOOL_LOCATION['longitude']
-                    )
-
-                    if distance > MAX_RADIUS_METERS:
-                        flash(f"Presensi gagal: Anda berada {distance:.0f}m dari sekolah", "danger")
-                        return redirect(url_for('presensi'))
-                except (ValueError, TypeError):
-                    pass
+            # Validasi GPS (koordinat yang tidak bisa dibaca dilewati seperti sebelumnya)
+            latitude, longitude = parse_coordinate(latitude), parse_coordinate(longitude)
+            if math.isnan(latitude) or math.isnan(longitude):
+                latitude = longitude = None  # disimpan NULL di kolom REAL
+            else:
+                inside, _, distance = geofence.locate(latitude, longitude)
+                if not inside:
+                    flash(f"Presensi gagal: Anda berada {distance:.0f}m di luar area sekolah", "danger")
+                    return redirect(url_for('presensi'))
 
             # Validasi Face Recognition (DUAL SYSTEM)
             verification_method = "Face-API.js Matching"
             face_verified = face_detected == 'true'
 
+            # Decode base64 sekali; bytes yang sama dipakai untuk verifikasi dan arsip foto
+            image_bytes = decode_image_data(image_data) if image_data else None
+
             # Fallback ke sistem lama jika face-API.js tidak mendeteksi
             if not face_verified and image_data:
-                face_verified, fallback_confidence, fallback_method = verify_face_with_fallbacks(user_id, image_data)
+                face_verified, fallback_confidence, fallback_method = face_service.verify(user_id, image_bytes)
                 face_confidence = fallback_confidence
                 verification_method = fallback_method
 
@@ -502,19 +2515,9 @@ def presensi():
                 flash("Wajah tidak terdeteksi. Pastikan wajah terlihat jelas!", "danger")
                 return redirect(url_for('presensi'))
 
-            # Simpan foto
-            if image_data and image_data.startswith('data:image'):
-                try:
-                    img_str = image_data.split(',')[1]
-                    img_bytes = base64.b64decode(img_str)
-                    filename = f"presensi_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-                    with open(file_path, 'wb') as f:
-                        f.write(img_bytes)
-                except Exception as e:
-                    print(f"Error saving image: {e}")
-                    filename = None
+            # Simpan foto (kompres, thumbnail & fsync dikerjakan di background)
+            if image_bytes and image_data.startswith('data:image'):
+                filename = photo_store.save(image_bytes)
 
             # Simpan presensi
             with db_connection() as conn:
@@ -526,10 +2529,13 @@ def presensi():
                 """, (user_id, today, waktu_masuk, waktu_keluar, status, keterangan, 
                      latitude, longitude, filename, face_confidence, face_verified, verification_method))
                 conn.commit()
+            response_cache.invalidate(CACHE_DASHBOARD_CHART)
 
             flash(f"Presensi berhasil! {verification_method}", "success")
             return redirect(url_for('dashboard'))
 
+        except FaceServiceBusy as e:
+            return str(e), 503, {'Retry-After': str(e.retry_after)}
         except Exception as e:
             flash(f"Error: {str(e)}", "danger")
             return redirect(url_for('presensi'))
@@ -539,29 +2545,65 @@ def presensi():
                          sudah_absen=sudah_absen,
                          presensi_hari_ini=presensi_hari_ini,
                          face_recognition_available=FACE_RECOGNITION_AVAILABLE,
-                         is_trained=is_trained)
+                         is_trained=is_trained,
+                         geofence_zones=app.config['GEOFENCE_ZONES'])
 
 # Routes lainnya
+def build_riwayat_query(user_id, bulan, after=None, limit=None):
+    """Riwayat satu user per bulan; after = [date, id] baris terakhir halaman sebelumnya"""
+    query = """
+        SELECT date, waktu_masuk, waktu_keluar, status, keterangan, 
+               latitude, longitude, image_filename,
+               face_confidence, verification_method, id,
+               COALESCE(menit_masuk > ?, 0) AS terlambat
+        FROM attendance WHERE user_id = ? AND date >= ? AND date < ? 
+    """
+    params = [minute_of_day(app.config['LATE_AFTER']), user_id, *month_bounds(bulan)]
+
+    if after:
+        date, row_id = after
+        query += " AND date <= ? AND (date < ? OR id < ?)"
+        params += [date, date, row_id]
+
+    query += " ORDER BY date DESC, id DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, params
+
+RIWAYAT_CURSOR_TYPES = (str, int)  # [date, id]
+
+def riwayat_cursor_key(row):
+    return [row['date'], row['id']]
+
 @app.route('/riwayat')
 @require_role('GURU', 'KARYAWAN', 'ADMIN', 'KEPALA SEKOLAH')
 def riwayat():
-    user = session['user']
+    user = current_user()
     bulan = request.args.get('bulan', datetime.now().strftime('%Y-%m'))
 
+    try:
+        month_bounds(bulan)
+    except ValueError:
+        flash("Format bulan tidak valid", "warning")
+        bulan = datetime.now().strftime('%Y-%m')
+
+    try:
+        after = decode_cursor(request.args.get('cursor'), RIWAYAT_CURSOR_TYPES)
+    except ValueError:
+        flash("Halaman tidak valid, kembali ke halaman pertama", "warning")
+        after = None
+
     with db_connection() as conn:
-        riwayat = conn.execute("""
-            SELECT date, waktu_masuk, waktu_keluar, status, keterangan, 
-                   face_confidence, verification_method
-            FROM attendance WHERE user_id = ? AND date LIKE ? 
-            ORDER BY date DESC
-        """, (user['id'], f"{bulan}-%")).fetchall()
+        page_size = page_size_arg()
+        query, params = build_riwayat_query(user['id'], bulan, after=after, limit=page_size + 1)
+        riwayat, next_cursor = fetch_page(conn, query, params, page_size, riwayat_cursor_key)
 
         rekap_data = conn.execute("""
-            SELECT status, COUNT(*) as count 
-            FROM attendance 
-            WHERE user_id = ? AND date LIKE ?
-            GROUP BY status
-        """, (user['id'], f"{bulan}-%")).fetchall()
+            SELECT status, count 
+            FROM attendance_monthly_user_summary 
+            WHERE user_id = ? AND month = ?
+        """, (user['id'], bulan)).fetchall()
 
         rekap = {'Hadir': 0, 'Izin': 0, 'Sakit': 0}
         for row in rekap_data:
@@ -573,12 +2615,40 @@ def riwayat():
                          riwayat=riwayat, 
                          user=user, 
                          rekap=rekap, 
-                         bulan=bulan)
+                         bulan=bulan,
+                         cursor=request.args.get('cursor', '') if after else '',
+                         next_cursor=next_cursor)
+
+@app.route('/api/riwayat')
+@require_role('GURU', 'KARYAWAN', 'ADMIN', 'KEPALA SEKOLAH')
+def api_riwayat():
+    """Riwayat presensi user per halaman (keyset cursor) dalam bentuk JSON"""
+    try:
+        after = decode_cursor(request.args.get('cursor'), RIWAYAT_CURSOR_TYPES)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Cursor tidak valid'}), 400
+
+    bulan = request.args.get('bulan', datetime.now().strftime('%Y-%m'))
+    try:
+        month_bounds(bulan)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Format bulan tidak valid (YYYY-MM)'}), 400
+
+    page_size = page_size_arg()
+    query, params = build_riwayat_query(session['user']['id'], bulan, after=after, limit=page_size + 1)
+    with db_connection() as conn:
+        rows, next_cursor = fetch_page(conn, query, params, page_size, riwayat_cursor_key)
+
+    return jsonify({
+        'success': True,
+        'items': [dict(row) for row in rows],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/profil', methods=['GET', 'POST'])
 @require_role('ADMIN', 'GURU', 'KARYAWAN', 'KEPALA SEKOLAH')
 def profil():
-    user = session['user']
+    user = current_user()
 
     if request.method == 'POST':
         try:
@@ -600,10 +2670,7 @@ def profil():
             # Upload reference photos
             for i, photo_file in enumerate([photo_ref1, photo_ref2], 1):
                 if photo_file and photo_file.filename != '' and allowed_file(photo_file.filename):
-                    filename = secure_filename(f"ref_{user['id']}_{i}_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg")
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    photo_file.save(file_path)
-                    filenames[f'photo_ref{i}'] = filename
+                    filenames[f'photo_ref{i}'] = photo_store.save(photo_file.read())
 
             with db_connection() as conn:
                 if password:
@@ -620,17 +2687,13 @@ def profil():
                     """, (name, email, nip, jabatan, 
                          filenames['photo_ref1'], filenames['photo_ref2'], user['id']))
                 conn.commit()
-
-            # Update session
-            user.update({
-                'name': name,
-                'email': email,
-                'nip': nip,
-                'jabatan': jabatan,
-                'photo_ref1': filenames['photo_ref1'],
-                'photo_ref2': filenames['photo_ref2']
-            })
-            session['user'] = user
+                # Ganti password mengubah stempel versi: session ini diperbarui, session lain keluar
+                session['user'] = session_identity(
+                    conn.execute("SELECT id, role, status, password FROM users WHERE id = ?", (user['id'],)).fetchone()
+                )
+            response_cache.invalidate(CACHE_REKAP_NAMA_LIST, CACHE_KELOLA_GURU)
+            face_index.invalidate(user['id'])  # nama di galeri kiosk
+            user_profiles.invalidate(user['id'])
 
             flash('Profil berhasil diperbarui!', 'success')
             return redirect(url_for('profil'))
@@ -640,55 +2703,299 @@ def profil():
 
     return render_template('profil.html', user=user, face_recognition_available=FACE_RECOGNITION_AVAILABLE)
 
+REKAP_EXPORT_COLUMNS = ['Nama', 'Tanggal', 'Masuk', 'Keluar', 'Status', 'Keterangan',
+                        'Confidence Wajah', 'Metode Verifikasi', 'Foto']
+EXPORT_CHUNK_ROWS = 500
+
+def rekap_filters(selected_nama, selected_tanggal):
+    """Klausa WHERE + parameter sesuai filter halaman rekap"""
+    where = ["1=1"]
+    params = []
+
+    if selected_nama:
+        where.append("u.name = ?")
+        params.append(selected_nama)
+    if selected_tanggal:
+        where.append("a.date = ?")
+        params.append(selected_tanggal)
+
+    return " AND ".join(where), params
+
+def build_rekap_query(selected_nama, selected_tanggal, after=None, limit=None):
+    """Query rekap; after = [date, name, id] baris terakhir halaman sebelumnya (keyset)"""
+    where, params = rekap_filters(selected_nama, selected_tanggal)
+
+    if after:
+        date, name, row_id = after
+        # a.date <= ? dulu supaya SQLite bisa mulai dari posisi cursor di index tanggal
+        where += " AND a.date <= ? AND (a.date < ? OR u.name > ? OR (u.name = ? AND a.id > ?))"
+        params += [date, date, name, name, row_id]
+
+    query = f"""
+        SELECT u.name, a.date, a.waktu_masuk, a.waktu_keluar, a.status, a.keterangan,
+               a.face_confidence, a.verification_method, a.image_filename, a.id
+        FROM attendance a
+        JOIN users u ON a.user_id = u.id
+        WHERE {where}
+        ORDER BY a.date DESC, u.name, a.id
+    """
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, params
+
+REKAP_CURSOR_TYPES = (str, str, int)  # [date, name, id]
+
+def rekap_cursor_key(row):
+    return [row['date'], row['name'], row['id']]
+
+def rekap_status_counts(conn, selected_nama, selected_tanggal):
+    """Jumlah per status sesuai filter rekap, dibaca dari tabel ringkasan bila bisa"""
+    if selected_nama and selected_tanggal:
+        # Paling banyak satu baris per user, hitung langsung
+        where, params = rekap_filters(selected_nama, selected_tanggal)
+        rows = conn.execute(f"""
+            SELECT a.status, COUNT(*) AS count
+            FROM attendance a
+            JOIN users u ON a.user_id = u.id
+            WHERE {where}
+            GROUP BY a.status
+        """, params).fetchall()
+    elif selected_nama:
+        rows = conn.execute("""
+            SELECT m.status, SUM(m.count) AS count
+            FROM attendance_monthly_user_summary m
+            JOIN users u ON m.user_id = u.id
+            WHERE u.name = ?
+            GROUP BY m.status
+        """, (selected_nama,)).fetchall()
+    elif selected_tanggal:
+        rows = conn.execute(
+            "SELECT status, count FROM attendance_daily_summary WHERE date = ?",
+            (selected_tanggal,)
+        ).fetchall()
+    else:
+        rows = conn.execute("SELECT status, count FROM attendance_status_summary").fetchall()
+    return {row['status']: row['count'] for row in rows}
+
+def stream_csv(query, params, header):
+    """Generator CSV per blok baris dari cursor - memori tetap kecil berapa pun jumlah data"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM supaya Excel membaca UTF-8 dengan benar
+    writer.writerow(header)
+
+    # Koneksi sendiri (bukan dari pool): dipegang selama download berjalan
+    conn = db_pool.connect_unpooled()
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            writer.writerows(tuple(row)[:len(header)] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        conn.close()
+    if buffer.tell():
+        yield buffer.getvalue()
+
 @app.route('/rekap')
 @require_role('ADMIN', 'KEPALA SEKOLAH')
 def rekap():
     selected_nama = request.args.get('nama', '')
     selected_tanggal = request.args.get('tanggal', '')
 
-    with db_connection() as conn:
-        nama_list = [row[0] for row in conn.execute("SELECT name FROM users WHERE role IN ('GURU', 'KARYAWAN') ORDER BY name").fetchall()]
-
-        query = """
-            SELECT u.name, a.date, a.waktu_masuk, a.waktu_keluar, a.status, a.keterangan,
-                   a.face_confidence, a.verification_method
-            FROM attendance a
-            JOIN users u ON a.user_id = u.id
-            WHERE 1=1
-        """
-        params = []
-
-        if selected_nama:
-            query += " AND u.name = ?"
-            params.append(selected_nama)
-        if selected_tanggal:
-            query += " AND a.date = ?"
-            params.append(selected_tanggal)
+    try:
+        after = decode_cursor(request.args.get('cursor'), REKAP_CURSOR_TYPES)
+    except ValueError:
+        flash("Halaman tidak valid, kembali ke halaman pertama", "warning")
+        after = None
 
-        query += " ORDER BY a.date DESC, u.name"
+    # Di luar blok koneksi: saat cache miss loader meminjam koneksi pool sendiri
+    nama_list = response_cache.get_or_set(CACHE_REKAP_NAMA_LIST, load_rekap_nama_list)
 
-        data = conn.execute(query, params).fetchall()
+    with db_connection() as conn:
+        page_size = page_size_arg()
+        query, params = build_rekap_query(selected_nama, selected_tanggal,
+                                          after=after, limit=page_size + 1)
+        data, next_cursor = fetch_page(conn, query, params, page_size, rekap_cursor_key)
 
-        total_hadir = sum(1 for row in data if row['status'] == 'Hadir')
-        total_izin = sum(1 for row in data if row['status'] == 'Izin')
-        total_sakit = sum(1 for row in data if row['status'] == 'Sakit')
+        counts = rekap_status_counts(conn, selected_nama, selected_tanggal)
 
     return render_template('rekap.html',
                          hasil=data,
                          nama_list=nama_list,
                          selected_nama=selected_nama,
                          selected_tanggal=selected_tanggal,
-                         total_hadir=total_hadir,
-                         total_izin=total_izin,
-                         total_sakit=total_sakit)
+                         total_hadir=counts.get('Hadir', 0),
+                         total_izin=counts.get('Izin', 0),
+                         total_sakit=counts.get('Sakit', 0),
+                         total_alpa=counts.get('Alpa', 0),
+                         cursor=request.args.get('cursor', '') if after else '',
+                         next_cursor=next_cursor)
+
+@app.route('/rekap/export')
+@require_role('ADMIN', 'KEPALA SEKOLAH')
+def rekap_export():
+    """Download rekap (filter sama dengan halaman rekap) sebagai CSV yang di-stream"""
+    selected_nama = request.args.get('nama', '')
+    selected_tanggal = request.args.get('tanggal', '')
+
+    query, params = build_rekap_query(selected_nama, selected_tanggal)
+    filename = f"rekap_presensi_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+
+    return Response(
+        stream_with_context(stream_csv(query, params, REKAP_EXPORT_COLUMNS)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/api/rekap')
+@require_role('ADMIN', 'KEPALA SEKOLAH')
+def api_rekap():
+    """Rekap per halaman (keyset cursor) dalam bentuk JSON"""
+    try:
+        after = decode_cursor(request.args.get('cursor'), REKAP_CURSOR_TYPES)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Cursor tidak valid'}), 400
+
+    page_size = page_size_arg()
+    query, params = build_rekap_query(request.args.get('nama', ''), request.args.get('tanggal', ''),
+                                      after=after, limit=page_size + 1)
+    with db_connection() as conn:
+        rows, next_cursor = fetch_page(conn, query, params, page_size, rekap_cursor_key)
+
+    return jsonify({
+        'success': True,
+        'items': [dict(row) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+SUMMARY_PERIODS = {
+    'harian': "date",
+    'mingguan': "strftime('%Y-W%W', date)",
+    'bulanan': "substr(date, 1, 7)",
+    'tahunan': "substr(date, 1, 4)",
+}
+
+@app.route('/api/rekap/summary')
+@require_role('ADMIN', 'KEPALA SEKOLAH')
+def api_rekap_summary():
+    """Rekap harian/mingguan/bulanan/tahunan dari tabel ringkasan (tanpa scan attendance)"""
+    periode = request.args.get('periode', 'bulanan')
+    if periode not in SUMMARY_PERIODS:
+        return jsonify({'success': False, 'message': 'Periode tidak dikenal'}), 400
+
+    dari = request.args.get('dari', '0000-00-00')
+    sampai = request.args.get('sampai', '9999-12-31')
+    key = SUMMARY_PERIODS[periode]
+
+    with db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT {key} AS periode, status, SUM(count) AS count
+            FROM attendance_daily_summary
+            WHERE date BETWEEN ? AND ?
+            GROUP BY periode, status
+            HAVING SUM(count) > 0
+            ORDER BY periode
+        """, (dari, sampai)).fetchall()
+
+    items = {}
+    for row in rows:
+        item = items.setdefault(row['periode'], {'periode': row['periode'], 'counts': {}, 'total': 0})
+        item['counts'][row['status']] = row['count']
+        item['total'] += row['count']
+
+    return jsonify({'success': True, 'periode': periode, 'items': list(items.values())})
 
 @app.route('/kelola_guru')
 @require_role('ADMIN', 'KEPALA SEKOLAH')
 def kelola_guru():
-    with db_connection() as conn:
-        data_guru = conn.execute("SELECT * FROM users WHERE role = 'GURU' ORDER BY name").fetchall()
+    data_guru = response_cache.get_or_set(CACHE_KELOLA_GURU, load_kelola_guru)
     return render_template('kelola_guru.html', data_guru=data_guru)
 
+@app.route('/api/users/import', methods=['POST'])
+@require_role('ADMIN', 'KEPALA SEKOLAH')
+def api_users_import():
+    """Import staf massal: file CSV `users_csv` + zip foto `photos_zip` (opsional).
+
+    Progres di-stream sebagai NDJSON, satu baris JSON per baris CSV; baris terakhir ringkasan.
+    Batch yang lebih besar dari MAX_CONTENT_LENGTH: pakai `python import_staff.py` di server.
+    """
+    users_csv = request.files.get('users_csv')
+    if not users_csv or not users_csv.filename:
+        return jsonify({'success': False, 'message': 'File CSV user wajib diunggah'}), 400
+    try:
+        csv_text = users_csv.read().decode('utf-8-sig')
+        photos_zip = request.files.get('photos_zip')
+        photos = PhotoSource(io.BytesIO(photos_zip.read())) if photos_zip and photos_zip.filename else None
+    except (UnicodeDecodeError, zipfile.BadZipFile) as e:
+        return jsonify({'success': False, 'message': f'File tidak valid: {e}'}), 400
+
+    def generate():
+        for progress in import_staff(csv_text, photos):
+            yield json.dumps(progress) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/db/pool-stats')
+@require_role('ADMIN')
+def api_db_pool_stats():
+    """Statistik pool koneksi database (checkout, waktu tunggu, koneksi aktif)"""
+    return jsonify({'success': True, 'pool': db_pool.stats(), 'chatbot_log': chatbot_log.stats()})
+
+@app.route('/api/cache-stats')
+@require_role('ADMIN')
+def api_cache_stats():
+    """Statistik cache data bersama (hit, miss, eviction)"""
+    return jsonify({'success': True, 'cache': response_cache.stats()})
+
+@app.route('/api/face/model-stats')
+@require_role('ADMIN')
+def api_face_model_stats():
+    """Statistik layanan analisis wajah: antrian, waktu load model, waktu inferensi"""
+    return jsonify({'success': True, 'face_service': face_service.stats()})
+
+def metrics_token_valid():
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return False
+    scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not secrets.compare_digest(supplied.strip(), token):
+        return False
+    allowed_ips = app.config['METRICS_ALLOWED_IPS']
+    return not allowed_ips or request.remote_addr in allowed_ips
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Histogram latency request & tahap internal dalam format teks Prometheus.
+
+    Akses: session admin, atau header `Authorization: Bearer <METRICS_TOKEN>` dari IP yang
+    diizinkan. IP saja tidak cukup - di belakang reverse proxy semua request dari 127.0.0.1.
+    """
+    if (current_user() or {}).get('role', '').upper() != 'ADMIN' and not metrics_token_valid():
+        return 'Forbidden', 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/debug/slow-requests', methods=['GET', 'POST'])
+@require_role('ADMIN')
+def api_slow_requests():
+    """GET: laporan stack terpanas request lambat. POST {threshold_ms}: nyalakan/matikan profiler"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            slow_request_profiler.set_threshold(max(0, int(data.get('threshold_ms', 0))))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'threshold_ms harus angka'}), 400
+    return jsonify({
+        'success': True,
+        'threshold_ms': slow_request_profiler.threshold_ms,
+        'reports': slow_request_profiler.reports(),
+    })
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -712,15 +3019,16 @@ def api_face_train():
                 'message': 'Tidak ada data wajah yang diterima'
             })
 
-        # Simpan face descriptors sebagai JSON
-        descriptors_json = json.dumps(descriptors)
+        # Simpan face descriptors sebagai BLOB float32
+        descriptors_blob = encode_descriptors(descriptors)
 
         with db_connection() as conn:
             conn.execute(
                 "UPDATE users SET face_descriptors = ?, face_trained_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (descriptors_json, user_id)
+                (descriptors_blob, user_id)
             )
             conn.commit()
+        face_index.invalidate(user_id)
 
         return jsonify({
             'success': True,
@@ -737,56 +3045,128 @@ def api_face_train():
 @app.route('/api/face/verify', methods=['POST'])
 @require_role('GURU', 'KARYAWAN', 'ADMIN', 'KEPALA SEKOLAH')
 def api_face_verify():
-    """API untuk verifikasi wajah dengan matching ke database"""
+    """API untuk verifikasi wajah dengan matching ke database.
+
+    Terima satu `descriptor` atau burst `descriptors` (beberapa frame terakhir) sekaligus.
+    """
     try:
         data = request.get_json()
+        descriptors = data.get('descriptors') or []
         descriptor = data.get('descriptor', [])
         user_id = session['user']['id']
 
-        if not descriptor:
+        if not descriptors and not descriptor:
             return jsonify({
                 'success': False,
                 'verified': False,
                 'message': 'Tidak ada descriptor wajah yang diterima'
             })
 
-        # Ambil stored descriptors user
-        with db_connection() as conn:
-            user = conn.execute(
-                "SELECT face_descriptors FROM users WHERE id = ?", 
-                (user_id,)
-            ).fetchone()
+        if descriptors:
+            return verify_descriptor_burst(user_id, descriptors[-FACE_BURST_MAX_FRAMES:])
+
+        # Bandingkan dengan descriptor tersimpan (cache di memori, tanpa query DB)
+        distances = face_index.distances(user_id, descriptor)
+        if distances is None:
+            return jsonify({
+                'success': False,
+                'verified': False,
+                'message': 'Anda belum melakukan training wajah. Silakan training terlebih dahulu.'
+            })
+
+        best_distance = float(distances.min())
 
-            if not user or not user['face_descriptors']:
-                return jsonify({
-                    'success': False,
-                    'verified': False,
-                    'message': 'Anda belum melakukan training wajah. Silakan training terlebih dahulu.'
-                })
+        # Threshold untuk face matching (bisa disesuaikan)
+        verified = best_distance < FACE_MATCH_THRESHOLD
+        confidence = max(0, 1 - best_distance)
 
-            # Compare dengan stored descriptors
-            stored_descriptors = json.loads(user['face_descriptors'])
-            best_distance = float('inf')
+        return jsonify({
+            'success': True,
+            'verified': verified,
+            'confidence': round(confidence, 2),
+            'distance': round(best_distance, 2),
+            'message': 'Wajah dikenali' if verified else 'Wajah tidak dikenali'
+        })
+
+    except Exception as e:
+        print(f"Face verification error: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        })
+
+def verify_descriptor_burst(user_id, descriptors):
+    """Nilai beberapa frame sekaligus; lolos jika median jarak < threshold dan cukup banyak frame cocok"""
+    per_frame = face_index.frame_distances(user_id, descriptors)
+    if per_frame is None:
+        return jsonify({
+            'success': False,
+            'verified': False,
+            'message': 'Anda belum melakukan training wajah. Silakan training terlebih dahulu.'
+        })
 
-            for stored_desc in stored_descriptors:
-                distance = np.linalg.norm(np.array(descriptor) - np.array(stored_desc))
-                if distance < best_distance:
-                    best_distance = distance
+    best_distance = float(per_frame.min())
+    median_distance = float(np.median(per_frame))
+    # Konsistensi antar frame: satu frame kebetulan mirip tidak cukup untuk lolos
+    consistency = float(np.mean(per_frame < FACE_MATCH_THRESHOLD))
+    frames = np.asarray(descriptors, dtype=np.float32)
+    frame_spread = float(np.linalg.norm(frames - frames.mean(axis=0), axis=1).mean())
+
+    verified = median_distance < FACE_MATCH_THRESHOLD and consistency >= FACE_BURST_MIN_CONSISTENCY
+    return jsonify({
+        'success': True,
+        'verified': verified,
+        'confidence': round(max(0, 1 - median_distance), 2),
+        'distance': round(median_distance, 2),
+        'best_distance': round(best_distance, 2),
+        'median_distance': round(median_distance, 2),
+        'consistency': round(consistency, 2),
+        'frame_spread': round(frame_spread, 3),  # ~0 = frame identik (mis. descriptor diputar ulang)
+        'frames': len(per_frame),
+        'message': 'Wajah dikenali' if verified else 'Wajah tidak dikenali'
+    })
+
+@app.route('/api/face/identify', methods=['POST'])
+@require_role('ADMIN', 'KEPALA SEKOLAH')
+def api_face_identify():
+    """API identifikasi wajah 1:N untuk kiosk presensi bersama"""
+    try:
+        data = request.get_json()
+        descriptor = data.get('descriptor', [])
 
-            # Threshold untuk face matching (bisa disesuaikan)
-            verified = best_distance < 0.6
-            confidence = max(0, 1 - best_distance)
+        if not descriptor:
+            return jsonify({
+                'success': False,
+                'identified': False,
+                'message': 'Tidak ada descriptor wajah yang diterima'
+            })
 
+        match = face_index.identify(descriptor)
+        if match is None:
             return jsonify({
-                'success': True,
-                'verified': verified,
-                'confidence': round(confidence, 2),
-                'distance': round(best_distance, 2),
-                'message': 'Wajah dikenali' if verified else 'Wajah tidak dikenali'
+                'success': False,
+                'identified': False,
+                'message': 'Belum ada user aktif yang melakukan training wajah.'
             })
 
+        best_distance = match['distance']
+        runner_up = match['runner_up_distance']
+        # Tolak jika dua orang sama-sama mirip, supaya presensi tidak tercatat ke orang lain
+        ambiguous = runner_up is not None and runner_up - best_distance < FACE_IDENTIFY_MARGIN
+        identified = best_distance < FACE_MATCH_THRESHOLD and not ambiguous
+
+        return jsonify({
+            'success': True,
+            'identified': identified,
+            'user': match['user'] if identified else None,
+            'confidence': round(max(0, 1 - best_distance), 2),
+            'distance': round(best_distance, 2),
+            'message': f"Wajah dikenali: {match['user']['name']}" if identified
+                       else 'Wajah tidak dikenali'
+        })
+
     except Exception as e:
-        print(f"Face verification error: {e}")
+        print(f"Face identification error: {e}")
         return jsonify({
             'success': False,
             'message': f'Error: {str(e)}'
@@ -834,6 +3214,7 @@ def api_face_reset_training():
                 (user_id,)
             )
             conn.commit()
+        face_index.invalidate(user_id)
 
         return jsonify({
             'success': True,
@@ -850,10 +3231,13 @@ def api_face_reset_training():
 
 @app.route('/chatbot', methods=['POST'])
 def chatbot():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
+        # Belum login, atau cookie lama (password / status user sudah berubah)
+        session.pop('user', None)
         return jsonify({'response': 'Silakan login terlebih dahulu 😊', 'type': 'error'})
 
-    user_id = session['user']['id']
+    user_id = user['id']
     data = request.get_json()
     user_message = data.get('message', '').lower().strip()
 
@@ -861,17 +3245,13 @@ def chatbot():
         return jsonify({'response': 'Pesan tidak boleh kosong', 'type': 'error'})
 
     try:
-        # Simpan pesan user ke database
         with db_connection() as conn:
             # Cari jawaban di knowledge base
-            bot_response = find_best_response(conn, user_message)
+            with metrics.span('find_best_response'):
+                bot_response = find_best_response(conn, user_message)
 
-            # Simpan conversation ke database
-            conn.execute(
-                "INSERT INTO chatbot_conversations (user_id, user_message, bot_response) VALUES (?, ?, ?)",
-                (user_id, user_message, bot_response['response'])
-            )
-            conn.commit()
+        # Simpan conversation lewat write-behind log (ditulis per batch di background)
+        chatbot_log.record(user_id, user_message, bot_response['response'])
 
         return jsonify({
             'response': bot_response['response'],
@@ -894,12 +3274,13 @@ def chatbot_history():
         user_id = session['user']['id']
         limit = request.args.get('limit', 10, type=int)
 
+        chatbot_log.flush()
         with db_connection() as conn:
             history = conn.execute('''
                 SELECT user_message, bot_response, created_at 
                 FROM chatbot_conversations 
                 WHERE user_id = ? 
-                ORDER BY created_at DESC 
+                ORDER BY created_at DESC, id DESC
                 LIMIT ?
             ''', (user_id, limit)).fetchall()
 
@@ -930,6 +3311,8 @@ def clear_chat_history():
     try:
         user_id = session['user']['id']
 
+        # Pesan yang masih di buffer harus masuk dulu supaya ikut terhapus
+        chatbot_log.flush()
         with db_connection() as conn:
             conn.execute(
                 "DELETE FROM chatbot_conversations WHERE user_id = ?",
@@ -952,6 +3335,7 @@ def clear_chat_history():
 @require_role('ADMIN', 'KEPALA SEKOLAH')
 def chatbot_knowledge_management():
     """Halaman management knowledge base (Admin only)"""
+    chatbot_log.flush()
     with db_connection() as conn:
         knowledge_items = conn.execute('''
             SELECT id, question_pattern, answer, category, tags, priority, is_active, created_at
@@ -988,14 +3372,43 @@ def add_chatbot_knowledge():
                 VALUES (?, ?, ?, ?, ?)
             ''', (question_pattern, answer, category, tags, priority))
             conn.commit()
+        chatbot_knowledge_cache.invalidate()
 
         return jsonify({'success': True, 'message': 'Knowledge berhasil ditambah'})
 
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
-@app.before_request
-def before_request():
+# ===== APP FACTORY & LIFECYCLE =====
+
+def create_app():
+    """Entry point WSGI: gunicorn -c gunicorn.conf.py "app:create_app()".
+
+    Konfigurasi sudah dibaca dari environment (PRESENSI_*) saat modul di-import. Dengan
+    preload, fungsi ini jalan sekali di proses master sebelum fork: model wajah untuk
+    analisis inline (FACE_WORKERS=0) dimuat di sini supaya dipakai bersama semua worker.
+    """
+    if app.config['FACE_WARMUP'] and app.config['FACE_WORKERS'] <= 0:
+        face_models.warm_up()
+    return app
+
+def start_worker():
+    """Persiapan per proses yang melayani request (setelah fork pada mode pre-fork)"""
+    if app.config['FACE_WARMUP']:
+        face_service.start()
+
+def shutdown_services():
+    """Tulis buffer yang tersisa & hentikan worker background (atexit / gunicorn worker_exit)"""
+    chatbot_log.shutdown()
+    metrics.dump()
+    photo_store.shutdown()
+    face_service.shutdown(wait=False)
+    db_pool.close_all()
+
+atexit.register(shutdown_services)
+
+# Migrasi skema sekali per proses saat modul di-load (flask run, python app.py, WSGI)
+with metrics.span('init_db'):
     init_db()
 
 if __name__ == '__main__':
@@ -1006,5 +3419,7 @@ if __name__ == '__main__':
     print(f"Upload Folder: {app.config['UPLOAD_FOLDER']}")
     print("=" * 50)
 
-    init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Server development (satu proses); production pakai gunicorn.conf.py
+    create_app()
+    start_worker()
+    app.run(host=os.environ.get('HOST', '0.0.0.0'), port=int(os.environ.get('PORT', 5000)), debug=app.debug)
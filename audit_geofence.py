@@ -0,0 +1,52 @@
+"""Audit lokasi presensi: validasi ulang semua presensi historis terhadap zona geofence aktif.
+
+Jalankan: python audit_geofence.py [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--csv luar_area.csv]
+
+Berguna setelah zona (PRESENSI_GEOFENCE_ZONES) diubah: semua baris dicek dalam satu pass NumPy.
+"""
+import argparse
+import csv
+import math
+import sys
+
+from app import audit_attendance_locations, geofence
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from', dest='date_from', help='tanggal awal (inklusif)')
+    parser.add_argument('--to', dest='date_to', help='tanggal akhir (inklusif)')
+    parser.add_argument('--csv', help='tulis presensi di luar area ke file CSV')
+    args = parser.parse_args()
+
+    rows, result = audit_attendance_locations(args.date_from, args.date_to)
+    no_location = [i for i, d in enumerate(result.distance_m) if math.isinf(d)]
+    outside = [i for i, inside in enumerate(result.inside) if not inside and not math.isinf(result.distance_m[i])]
+
+    print("=" * 60)
+    print(f"AUDIT GEOFENCE ({len(rows)} presensi, {len(geofence.names)} zona)")
+    print("=" * 60)
+    for index, name in enumerate(geofence.names):
+        print(f"{name:<40}{int((result.zone == index).sum()):>10} presensi")
+    print(f"{'Di luar area':<40}{len(outside):>10} presensi")
+    print(f"{'Tanpa koordinat valid':<40}{len(no_location):>10} presensi")
+
+    if outside:
+        print("-" * 60)
+        print("Terjauh di luar area:")
+        for i in sorted(outside, key=lambda i: -result.distance_m[i])[:10]:
+            row = rows[i]
+            print(f"  #{row['id']} user {row['user_id']} {row['date']}: {result.distance_m[i]:.0f} m")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'user_id', 'date', 'latitude', 'longitude', 'jarak_m'])
+            for i in outside:
+                row = rows[i]
+                writer.writerow([row['id'], row['user_id'], row['date'], row['latitude'], row['longitude'],
+                                 f"{result.distance_m[i]:.1f}"])
+        print(f"{len(outside)} baris ditulis ke {args.csv}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Benchmark matcher chatbot: Jaccard (inverted index) vs TF-IDF.
+
+Test set akurasi diambil dari log chatbot_conversations:
+- pesan yang dulu dijawab dengan jawaban knowledge base -> harus dapat jawaban itu
+- pesan yang dulu dapat jawaban default ("belum paham") -> tidak boleh dapat jawaban knowledge
+Karena log berasal dari matcher Jaccard, ditambah parafrase sintetis dari setiap pattern
+(kata hilang, typo, kata pengisi) supaya kemampuan generalisasi ikut terukur.
+
+Jalankan: python bench_chatbot.py [iterasi]
+"""
+import random
+import sys
+import time
+
+from app import (db_connection, find_best_response, CHATBOT_DEFAULT_RESPONSE,
+                 CHATBOT_MATCHERS)
+
+FILLERS = ['tolong', 'gimana', 'ya', 'dong', 'bagaimana', 'saya', 'mau']
+
+def load_knowledge(conn):
+    return conn.execute('''
+        SELECT question_pattern, answer
+        FROM chatbot_knowledge
+        WHERE is_active = TRUE
+        ORDER BY priority DESC
+    ''').fetchall()
+
+def logged_cases(conn, answers):
+    """(pesan, jawaban yang diharapkan / None) dari log percakapan"""
+    cases = {}
+    for message, response in conn.execute(
+            "SELECT user_message, bot_response FROM chatbot_conversations"):
+        message = (message or '').lower().strip()
+        if not message:
+            continue
+        if response in answers:
+            cases[message] = response
+        elif response == CHATBOT_DEFAULT_RESPONSE['response']:
+            cases.setdefault(message, None)
+    return list(cases.items())
+
+def paraphrase_cases(knowledge, seed=0):
+    """Variasi pattern: hapus satu kata, typo (tukar dua huruf), tambah kata pengisi"""
+    rng = random.Random(seed)
+    cases = []
+    for pattern, answer in knowledge:
+        for p in pattern.split('|'):
+            words = p.split()
+            if len(words) > 1:
+                dropped = list(words)
+                dropped.pop(rng.randrange(len(dropped)))
+                cases.append((' '.join(dropped), answer))
+            typo = list(words)
+            i = rng.randrange(len(typo))
+            if len(typo[i]) > 3:
+                j = rng.randrange(1, len(typo[i]) - 1)
+                w = typo[i]
+                typo[i] = w[:j] + w[j + 1] + w[j] + w[j + 2:]
+                cases.append((' '.join(typo), answer))
+            cases.append((' '.join([rng.choice(FILLERS)] + words + [rng.choice(FILLERS)]), answer))
+    return cases
+
+def evaluate(matcher, cases):
+    hit = wrong = false_positive = positives = negatives = 0
+    for message, expected in cases:
+        answer, score = matcher.best_match(message)
+        answered = answer if answer is not None and score > matcher.threshold else None
+        if expected is None:
+            negatives += 1
+            false_positive += answered is not None
+        else:
+            positives += 1
+            hit += answered == expected
+            wrong += answered is not None and answered != expected
+    return hit, wrong, false_positive, positives, negatives
+
+def latency_us(matcher, messages, iterations):
+    samples = []
+    for _ in range(iterations):
+        for message in messages:
+            start = time.perf_counter()
+            matcher.best_match(message)
+            samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return sum(samples) / len(samples), samples[int(len(samples) * 0.95)]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with db_connection() as conn:
+        knowledge = load_knowledge(conn)
+        answers = {answer for _, answer in knowledge}
+        logged = logged_cases(conn, answers)
+        # Pastikan find_best_response tetap jalan dengan mode yang aktif
+        find_best_response(conn, 'cara presensi')
+    synthetic = paraphrase_cases(knowledge)
+    messages = [m for m, _ in logged + synthetic] or ['cara presensi']
+
+    print("=" * 72)
+    print(f"CHATBOT MATCHER BENCHMARK ({len(knowledge)} knowledge, "
+          f"{len(logged)} pesan log, {len(synthetic)} parafrase, {iterations} iterasi)")
+    print("=" * 72)
+    print(f"{'matcher':<10}{'build (ms)':>12}{'mean (us)':>11}{'p95 (us)':>10}"
+          f"{'hit log':>10}{'hit para':>10}{'salah':>8}{'FP':>6}")
+    for name, matcher_class in CHATBOT_MATCHERS.items():
+        start = time.perf_counter()
+        matcher = matcher_class(knowledge)
+        build_ms = (time.perf_counter() - start) * 1e3
+        mean, p95 = latency_us(matcher, messages, iterations)
+
+        log_hit, log_wrong, log_fp, log_pos, _ = evaluate(matcher, logged)
+        para_hit, para_wrong, _, para_pos, _ = evaluate(matcher, synthetic)
+        log_rate = f"{log_hit / log_pos:.0%}" if log_pos else '-'
+        para_rate = f"{para_hit / para_pos:.0%}" if para_pos else '-'
+        print(f"{name:<10}{build_ms:>12.2f}{mean:>11.1f}{p95:>10.1f}"
+              f"{log_rate:>10}{para_rate:>10}{log_wrong + para_wrong:>8}{log_fp:>6}")
+    print("-" * 72)
+    print("hit = jawaban benar di atas threshold, salah = jawaban knowledge lain,")
+    print("FP = pesan log yang dulu tidak terjawab tapi sekarang dijawab knowledge")
+
+if __name__ == '__main__':
+    main()
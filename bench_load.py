@@ -0,0 +1,338 @@
+"""Load test lokal: ratusan guru login, polling /api/face/verify, lalu presensi.
+
+Database sintetis (user, face descriptor, riwayat presensi 1 tahun) dibuat di folder kerja
+terpisah supaya attendance.db asli tidak tersentuh. Traffic diputar ulang lewat Flask test
+client (default) atau ke server lokal yang berjalan di folder kerja yang sama (--url).
+
+Jalankan:
+  python bench_load.py                       # seed (jika belum ada) + replay, bandingkan baseline
+  python bench_load.py --users 300 --concurrency 32 --reseed
+  python bench_load.py --save-baseline       # simpan hasil sebagai baseline baru
+  python bench_load.py --url http://127.0.0.1:8000 --workdir bench_work
+
+Exit code 1 jika p95 atau throughput sebuah route lebih buruk dari baseline melebihi toleransi.
+"""
+import argparse
+import base64
+import http.cookiejar
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'bench_baseline.json')
+PASSWORD = 'bench-password'
+STATUSES = ['Hadir'] * 17 + ['Izin', 'Sakit', 'Alpa']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workdir', default=os.path.join(REPO_DIR, 'bench_work'),
+                        help='folder berisi attendance.db sintetis dan static/uploads')
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--days', type=int, default=365, help='panjang riwayat presensi')
+    parser.add_argument('--reseed', action='store_true', help='buat ulang database sintetis')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--polls', type=int, default=5, help='polling /api/face/verify per user')
+    parser.add_argument('--burst', type=int, default=3,
+                        help='descriptor per polling (seperti presensi.html); 0 = satu descriptor lama')
+    parser.add_argument('--image-ratio', type=float, default=0.1,
+                        help='porsi presensi yang mengirim foto (fallback analisis server)')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='sebar kedatangan user dalam N detik (0 = secepatnya)')
+    parser.add_argument('--url', help='base URL server lokal; default Flask test client')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='batas regresi relatif terhadap baseline (0.25 = 25%%)')
+    return parser.parse_args()
+
+# ===== SEED =====
+
+def seed_database(app_module, users, days, rng):
+    """Isi database kosong dengan user, descriptor wajah, dan riwayat presensi"""
+    from werkzeug.security import generate_password_hash
+
+    hashed = generate_password_hash(PASSWORD)  # satu hash untuk semua user: seed tetap cepat
+    today = date.today()
+    with app_module.db_connection() as conn:
+        user_rows = []
+        for i in range(users):
+            descriptors = rng.uniform(-0.3, 0.3, size=(3, 128)).astype(np.float32)
+            user_rows.append((
+                f'Staff {i:04d}', f'staff{i:04d}@bench.local', hashed,
+                'GURU' if i % 4 else 'KARYAWAN', f'{198000000 + i}', 'Guru Mapel',
+                app_module.encode_descriptors(descriptors),
+            ))
+        conn.executemany("""
+            INSERT INTO users (name, email, password, role, nip, jabatan, face_descriptors, face_trained_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, user_rows)
+
+        user_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM users WHERE email LIKE '%@bench.local' ORDER BY id")]
+        loc = school_location(app_module)
+        for offset in range(days, 0, -1):
+            day = today - timedelta(days=offset)
+            if day.weekday() == 6:  # Minggu libur
+                continue
+            rows = []
+            for user_id in user_ids:
+                minute = int(rng.integers(0, 60))
+                rows.append((
+                    user_id, day.isoformat(), f'06:{minute:02d}', '14:00',
+                    STATUSES[int(rng.integers(0, len(STATUSES)))], '',
+                    f"{loc['latitude'] + rng.normal(0, 0.0002):.6f}",
+                    f"{loc['longitude'] + rng.normal(0, 0.0002):.6f}",
+                    round(float(rng.uniform(0.6, 0.95)), 2), True, 'Face-API.js Matching',
+                ))
+            conn.executemany("""
+                INSERT INTO attendance (user_id, date, waktu_masuk, waktu_keluar, status, keterangan,
+                    latitude, longitude, face_confidence, face_verified, verification_method)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+        conn.commit()
+    return len(user_ids)
+
+def school_location(app_module):
+    """Titik tengah zona geofence pertama: koordinat presensi sintetis di sekitarnya"""
+    latitude, longitude = app_module.geofence.centers()[0]
+    return {'latitude': latitude, 'longitude': longitude}
+
+def load_staff(app_module):
+    with app_module.db_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, email, face_descriptors FROM users WHERE email LIKE '%@bench.local' ORDER BY id"
+        ).fetchall()
+        # Hapus presensi hari ini supaya setiap replay mengukur jalur insert, bukan duplikat
+        conn.execute("DELETE FROM attendance WHERE date = ?", (date.today().isoformat(),))
+        conn.commit()
+    return [(row['email'], app_module.decode_descriptors(row['face_descriptors'])) for row in rows]
+
+def sample_jpeg():
+    from PIL import Image
+    gradient = np.tile(np.linspace(0, 255, 320, dtype=np.uint8), (240, 1))
+    buffer = io.BytesIO()
+    Image.fromarray(gradient).convert('RGB').save(buffer, 'JPEG', quality=80)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+# ===== CLIENT =====
+
+class TestClientSession:
+    """Satu user lewat Flask test client (cookie session per client)"""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def post(self, path, data=None, json_body=None):
+        response = self.client.post(path, data=data, json=json_body)
+        return response.status_code
+
+class HttpSession:
+    """Satu user lewat HTTP ke server lokal (cookie jar per user, redirect tidak diikuti)"""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect)
+
+    def post(self, path, data=None, json_body=None):
+        if json_body is not None:
+            body, content_type = json.dumps(json_body).encode(), 'application/json'
+        else:
+            body, content_type = urllib.parse.urlencode(data or {}).encode(), 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(self.base_url + path, data=body,
+                                         headers={'Content-Type': content_type})
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+# ===== REPLAY =====
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def timed(self, route, fn):
+        start = time.perf_counter()
+        status = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if status >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status
+
+def staff_visit(session, recorder, email, descriptors, args, rng, photo, location):
+    """Skenario satu guru: login -> polling verifikasi wajah -> submit presensi"""
+    recorder.timed('POST /login', lambda: session.post(
+        '/login', data={'email': email, 'password': PASSWORD}))
+
+    for _ in range(args.polls):
+        # Descriptor dari kamera = descriptor training + noise kecil
+        picks = descriptors[rng.integers(0, len(descriptors), size=max(1, args.burst))]
+        frames = (picks + rng.normal(0, 0.02, picks.shape)).astype(float)
+        body = {'descriptors': frames.tolist()} if args.burst else {'descriptor': frames[0].tolist()}
+        recorder.timed('POST /api/face/verify', lambda: session.post('/api/face/verify', json_body=body))
+
+    form = {
+        'waktu_masuk': time.strftime('%H:%M'), 'waktu_keluar': '', 'status': 'Hadir',
+        'latitude': f"{location['latitude'] + rng.normal(0, 0.0001):.6f}",
+        'longitude': f"{location['longitude'] + rng.normal(0, 0.0001):.6f}",
+        'face_detected': 'true', 'face_confidence': '0.82',
+    }
+    if rng.random() < args.image_ratio:
+        form.update(image_data=photo, face_detected='false')
+    recorder.timed('POST /presensi', lambda: session.post('/presensi', data=form))
+
+def replay(app_module, staff, args):
+    recorder = Recorder()
+    photo = sample_jpeg()
+    order = list(range(len(staff)))
+    random.Random(args.seed).shuffle(order)
+    cursor = iter(enumerate(order))
+    cursor_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def worker(worker_id):
+        rng = np.random.default_rng(args.seed + worker_id)
+        while True:
+            with cursor_lock:
+                position, index = next(cursor, (None, None))
+            if index is None:
+                return
+            if args.duration:
+                # Kedatangan merata sepanjang durasi (jam datang guru tidak serentak)
+                delay = started + args.duration * position / len(order) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            session = HttpSession(args.url) if args.url else TestClientSession(app_module.app)
+            email, descriptors = staff[index]
+            staff_visit(session, recorder, email, descriptors, args, rng, photo,
+                        school_location(app_module))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+def summarize(recorder, wall_time):
+    results = {}
+    for route, samples in sorted(recorder.samples.items()):
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        results[route] = {
+            'requests': len(samples),
+            'errors': recorder.errors.get(route, 0),
+            'p50_ms': round(float(p50), 2),
+            'p95_ms': round(float(p95), 2),
+            'p99_ms': round(float(p99), 2),
+            'throughput_rps': round(len(samples) / wall_time, 1),
+        }
+    return results
+
+# Parameter run yang harus sama dengan baseline supaya angka bisa dibandingkan
+RUN_PARAMETERS = ('users', 'concurrency', 'polls', 'burst', 'image_ratio', 'duration', 'mode')
+
+def compare(run, baseline, tolerance):
+    """Daftar regresi terhadap baseline: parameter berbeda, error bertambah,
+    p95 lebih lambat / throughput lebih rendah"""
+    regressions = [f"parameter {key}={run.get(key)!r} berbeda dari baseline {baseline.get(key)!r}"
+                   for key in RUN_PARAMETERS if run.get(key) != baseline.get(key)]
+    if regressions:
+        return regressions
+
+    results = run['routes']
+    for route, base in baseline.get('routes', {}).items():
+        current = results.get(route)
+        if current is None:
+            continue
+        if current['errors'] > base.get('errors', 0):
+            regressions.append(f"{route}: {current['errors']} error > baseline {base.get('errors', 0)}")
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {current['p95_ms']}ms > baseline {base['p95_ms']}ms")
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{route}: throughput {current['throughput_rps']}/s "
+                               f"< baseline {base['throughput_rps']}/s")
+    return regressions
+
+def main():
+    args = parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    db_path = os.path.join(args.workdir, 'attendance.db')
+    if args.reseed:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    fresh = not os.path.exists(db_path)
+
+    # app memakai path relatif (attendance.db, static/uploads): jalankan dari folder kerja
+    os.chdir(args.workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+
+    if fresh:
+        start = time.perf_counter()
+        count = seed_database(app_module, args.users, args.days, np.random.default_rng(args.seed))
+        print(f"Seed: {count} user, {args.days} hari riwayat ({time.perf_counter() - start:.1f}s)")
+    staff = load_staff(app_module)[:args.users]
+
+    recorder, wall_time = replay(app_module, staff, args)
+    app_module.photo_store.flush()
+    results = summarize(recorder, wall_time)
+
+    print("=" * 86)
+    print(f"LOAD TEST ({len(staff)} user, concurrency {args.concurrency}, "
+          f"{'HTTP ' + args.url if args.url else 'test client'}, {wall_time:.1f}s)")
+    print("=" * 86)
+    print(f"{'route':<26}{'requests':>10}{'errors':>8}{'p50 (ms)':>11}{'p95 (ms)':>11}"
+          f"{'p99 (ms)':>11}{'req/s':>9}")
+    for route, r in results.items():
+        print(f"{route:<26}{r['requests']:>10}{r['errors']:>8}{r['p50_ms']:>11.2f}"
+              f"{r['p95_ms']:>11.2f}{r['p99_ms']:>11.2f}{r['throughput_rps']:>9.1f}")
+    print("-" * 86)
+
+    run = {
+        'users': len(staff), 'concurrency': args.concurrency, 'polls': args.polls, 'burst': args.burst,
+        'image_ratio': args.image_ratio, 'duration': args.duration,
+        'mode': 'http' if args.url else 'test_client',
+        'routes': results,
+    }
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline disimpan: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Belum ada baseline (jalankan dengan --save-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(run, baseline, args.tolerance)
+    for line in regressions:
+        print(f"[REGRESI] {line}")
+    print(f"{len(regressions)} regresi dibanding baseline ({args.baseline})")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
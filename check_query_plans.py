@@ -0,0 +1,68 @@
+"""Cek regresi query plan: query di route presensi tidak boleh full table scan.
+
+Jalankan: python check_query_plans.py  (exit code 1 jika ada query yang full scan)
+"""
+import re
+import sys
+
+from app import app, db_connection, build_rekap_query, build_riwayat_query
+
+# "SCAN attendance" tanpa "USING ... INDEX" = membaca seluruh tabel
+FULL_SCAN = re.compile(r"^SCAN \w+\b(?! USING)")
+
+def route_queries():
+    """(nama, sql, params) untuk query yang dipakai route-route utama"""
+    queries = [
+        ('login', "SELECT * FROM users WHERE email = ? AND status = 'Aktif'", ['admin@example.com']),
+        ('presensi: cek duplikat', "SELECT id FROM attendance WHERE user_id = ? AND date = ?", [1, '2025-01-06']),
+        ('dashboard: grafik 7 hari', """
+            SELECT date, SUM(count) as count FROM attendance_daily_summary
+            WHERE date >= date('now', '-6 days')
+            GROUP BY date HAVING SUM(count) > 0 ORDER BY date""", []),
+        ('dashboard: riwayat terakhir', """
+            SELECT date, waktu_masuk, waktu_keluar, status, keterangan
+            FROM attendance WHERE user_id = ?
+            ORDER BY date DESC LIMIT 5""", [1]),
+        ('riwayat: rekap bulanan', """
+            SELECT status, count FROM attendance_monthly_user_summary
+            WHERE user_id = ? AND month = ?""", [1, '2025-01']),
+        ('rekap: daftar nama', "SELECT name FROM users WHERE role IN ('GURU', 'KARYAWAN') ORDER BY name", []),
+        ('kelola_guru', "SELECT * FROM users WHERE role = 'GURU' ORDER BY name", []),
+        ('chatbot: history', """
+            SELECT user_message, bot_response, created_at
+            FROM chatbot_conversations WHERE user_id = ?
+            ORDER BY created_at DESC, id DESC LIMIT ?""", [1, 10]),
+        ('analisis: keterlambatan per bulan', """
+            SELECT bulan, COUNT(*), AVG(menit_masuk - ?) FROM attendance
+            WHERE tahun = ? AND menit_masuk > ? GROUP BY bulan""", [420, 2025, 420]),
+    ]
+
+    for label, after in [('halaman 1', None), ('halaman berikutnya', ['2025-01-06', 'Admin', 10])]:
+        for nama, tanggal in [('', ''), ('Admin', ''), ('', '2025-01-06'), ('Admin', '2025-01-06')]:
+            query, params = build_rekap_query(nama, tanggal, after=after, limit=51)
+            queries.append((f"rekap: nama={nama!r} tanggal={tanggal!r} {label}", query, params))
+
+        riwayat_after = after and [after[0], after[2]]
+        query, params = build_riwayat_query(1, '2025-01', after=riwayat_after, limit=51)
+        queries.append((f"riwayat: {label}", query, params))
+
+    return queries
+
+def main():
+    failures = 0
+    with db_connection() as conn:
+        for name, query, params in route_queries():
+            plan = [row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+            scans = [detail for detail in plan if FULL_SCAN.match(detail)]
+            status = 'FULL SCAN' if scans else 'OK'
+            print(f"[{status:>9}] {name}")
+            for detail in plan:
+                print(f"              {detail}")
+            failures += bool(scans)
+
+    print("-" * 50)
+    print(f"Database: {app.config['DATABASE']} - {failures} query full scan")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""Analisis wajah yang dijalankan di process pool (FaceAnalysisService di app.py).
+
+Worker memakai start method spawn, jadi modul ini di-import ulang di setiap worker:
+jangan taruh efek samping di sini (database, config Flask, thread background, file).
+"""
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+# Try to import face recognition with fallback
+try:
+    import face_recognition
+    FACE_RECOGNITION_AVAILABLE = True
+    print("✅ Face recognition loaded successfully")
+except ImportError as e:
+    print(f"❌ Face recognition not available: {e}")
+    FACE_RECOGNITION_AVAILABLE = False
+    # Fallback: simple face detection using OpenCV
+    try:
+        import cv2
+        print("✅ Using OpenCV as fallback")
+    except ImportError:
+        print("❌ OpenCV also not available")
+
+# ===== FACE MODEL REGISTRY =====
+
+def load_haar_cascade():
+    import cv2
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    if cascade.empty():
+        raise RuntimeError("Haar cascade tidak bisa dimuat")
+    return cascade
+
+def load_face_recognition_models():
+    # Model dlib diinisialisasi saat pemakaian pertama; paksa sekarang dengan gambar kosong
+    face_recognition.face_encodings(np.zeros((64, 64, 3), dtype=np.uint8))
+    return face_recognition
+
+class FaceModelRegistry:
+    """Muat detektor wajah sekali per proses, catat waktu load dan waktu inferensi"""
+
+    def __init__(self, loaders):
+        self._loaders = loaders
+        self._models = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def available(self):
+        names = ['haar_cascade']
+        if FACE_RECOGNITION_AVAILABLE:
+            names.insert(0, 'face_recognition')
+        return names
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            if name not in self._models:
+                start = time.perf_counter()
+                self._models[name] = self._loaders[name]()
+                self._metric(name)['load_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            return self._models[name]
+
+    def _metric(self, name):
+        return self._metrics.setdefault(name, {'load_ms': None, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                metric = self._metric(name)
+                metric['calls'] += 1
+                metric['total_ms'] += elapsed
+                metric['max_ms'] = max(metric['max_ms'], elapsed)
+
+    def warm_up(self):
+        for name in self.available():
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"Warm-up model {name} gagal: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(metric) for name, metric in self._metrics.items()}
+
+face_models = FaceModelRegistry({
+    'haar_cascade': load_haar_cascade,
+    'face_recognition': load_face_recognition_models,
+})
+
+def warm_up_face_models():
+    """Initializer worker process: model sudah siap sebelum job pertama datang"""
+    face_models.warm_up()
+
+# ===== IMAGE PREPROCESSING =====
+
+FACE_DETECT_MAX_SIDE = 640  # sisi terpanjang gambar untuk deteksi wajah
+
+PreparedFrame = namedtuple('PreparedFrame', ['raw', 'rgb', 'gray'])
+
+def prepare_frame(image_bytes, max_side=FACE_DETECT_MAX_SIDE):
+    """Decode JPEG sekali menjadi array RGB & grayscale kecil yang dipakai semua tahap deteksi"""
+    image = Image.open(io.BytesIO(image_bytes))
+    scale = min(1.0, max_side / max(image.size))
+    target = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    # draft(): decoder JPEG langsung menghasilkan skala 1/2, 1/4, 1/8 - hemat CPU & memori
+    image.draft('RGB', target)
+    image = image.convert('RGB')
+    if image.size != target:
+        image = image.resize(target, Image.BILINEAR)
+    return PreparedFrame(
+        raw=image_bytes,
+        rgb=np.array(image),
+        gray=np.array(image.convert('L')),
+    )
+
+def simple_face_detection(frame):
+    """Simple face detection using OpenCV as fallback"""
+    try:
+        # Face detector dari registry (dimuat sekali per proses)
+        face_cascade = face_models.get('haar_cascade')
+
+        # Detect faces (frame.gray sudah grayscale & diperkecil)
+        with face_models.timed('haar_cascade'):
+            faces = face_cascade.detectMultiScale(frame.gray, 1.1, 4)
+
+        return len(faces) > 0, len(faces)
+    except Exception as e:
+        print(f"Simple face detection error: {e}")
+        return False, 0
+
+def verify_face_with_fallbacks(user_id, frame):
+    """Verify face with multiple fallback methods"""
+
+    # Method 1: Using face_recognition library
+    if FACE_RECOGNITION_AVAILABLE:
+        try:
+            # Get face encodings
+            face_models.get('face_recognition')
+            with face_models.timed('face_recognition'):
+                face_encodings = face_recognition.face_encodings(frame.rgb)
+
+            if len(face_encodings) > 0:
+                # For now, just return that a face was detected
+                # In a real system, you'd compare with reference photos
+                return True, 0.8, "Face detected (face_recognition)"
+            else:
+                return False, 0.0, "No face detected"
+
+        except Exception as e:
+            print(f"Face recognition error: {e}")
+
+    # Method 2: Simple face detection with OpenCV
+    try:
+        face_detected, face_count = simple_face_detection(frame)
+        if face_detected:
+            return True, 0.7, f"Face detected (OpenCV) - {face_count} faces"
+        else:
+            return False, 0.0, "No face detected (OpenCV)"
+    except Exception as e:
+        print(f"OpenCV face detection error: {e}")
+
+    # Method 3: Basic validation - gambar berhasil didecode
+    return True, 0.5, "Image validated (basic check)"
+
+# ===== JOBS =====
+
+def run_face_job(user_id, image_bytes):
+    """Dijalankan di worker process: hasil verifikasi, snapshot metrik model worker tsb,
+    dan durasi per tahap (dicatat ke histogram oleh proses web)
+    """
+    timings = {}
+    start = time.perf_counter()
+    try:
+        frame = prepare_frame(image_bytes)
+    except Exception:
+        result = (False, 0.0, "Invalid image")
+    else:
+        decoded = time.perf_counter()
+        timings['face_decode'] = decoded - start
+        result = verify_face_with_fallbacks(user_id, frame)
+        timings['verify_face_with_fallbacks'] = time.perf_counter() - decoded
+    return result, os.getpid(), face_models.stats(), timings
+
+def extract_descriptors_job(image_bytes):
+    """Dijalankan di worker process: descriptor 128-d dari foto referensi.
+
+    Return [descriptor] jika ada wajah, [] jika tidak ada wajah, None jika library
+    face_recognition tidak tersedia (user tetap training lewat browser).
+    """
+    if not FACE_RECOGNITION_AVAILABLE:
+        return None
+    frame = prepare_frame(image_bytes)
+    face_models.get('face_recognition')
+    with face_models.timed('face_recognition'):
+        encodings = face_recognition.face_encodings(frame.rgb)
+    return [[float(v) for v in encodings[0]]] if len(encodings) else []
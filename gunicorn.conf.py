@@ -0,0 +1,54 @@
+"""Profil serving production: gunicorn pre-fork multi-worker.
+
+Jalankan: gunicorn -c gunicorn.conf.py "app:create_app()"
+
+Semua nilai bisa diubah lewat environment, contoh:
+  WEB_CONCURRENCY=4 WEB_THREADS=8 PRESENSI_FACE_WORKERS=1 PRESENSI_FACE_WARMUP=true
+Total proses analisis wajah = WEB_CONCURRENCY x PRESENSI_FACE_WORKERS. Default FACE_WORKERS
+membagi budget CPU dengan WEB_CONCURRENCY (minimal 1 per worker); 0 = inline di thread request.
+"""
+import os
+import shutil
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 2))
+# Dibaca app.py (preload di master) untuk default PRESENSI_FACE_WORKERS
+os.environ['WEB_CONCURRENCY'] = str(workers)
+threads = int(os.environ.get('WEB_THREADS', 4))  # >1 otomatis memakai worker gthread
+worker_class = 'gthread'
+
+# Import app (migrasi, config, model wajah inline) sekali di master, lalu fork
+preload_app = True
+
+# Worker recycling: restart worker setelah sekian request supaya memori tidak terus naik
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 100))
+
+# Graceful shutdown: request yang sedang jalan (mis. verifikasi wajah) diberi waktu selesai
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+
+# /metrics & profiler request lambat digabung dari semua worker lewat folder bersama ini.
+# Dikosongkan saat server start supaya angka dari run sebelumnya tidak ikut terhitung.
+metrics_dir = os.environ.setdefault('PRESENSI_METRICS_DIR', os.path.join('instance', 'metrics'))
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+def pre_fork(server, worker):
+    # Koneksi SQLite tidak boleh dibawa melewati fork: master menutup pool miliknya
+    import app
+    app.db_pool.close_all()
+
+def post_fork(server, worker):
+    import app
+    # Histogram & laporan profiler warisan master jangan dihitung ulang oleh tiap worker
+    app.metrics.reset()
+    app.slow_request_profiler.reset()
+    app.start_worker()
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_services()
@@ -0,0 +1,40 @@
+"""Import staf massal dari CSV + folder/zip foto referensi, langsung di server.
+
+Jalankan: python import_staff.py users.csv [folder_foto | foto.zip]
+
+Kolom CSV: name,email,password,role,nip,jabatan,status,photo
+Foto dicari lewat kolom photo, lalu nip atau email + .jpg/.jpeg/.png.
+"""
+import sys
+
+from app import import_staff, PhotoSource, shutdown_services
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 2
+
+    with open(sys.argv[1], encoding='utf-8-sig') as f:
+        csv_text = f.read()
+    photos = PhotoSource(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    summary = {}
+    for progress in import_staff(csv_text, photos):
+        if progress['status'] == 'done':
+            summary = progress
+        elif progress['status'] == 'error':
+            print(f"[ERROR] baris {progress['line']} {progress['email']}: {progress['message']}")
+        elif progress['status'] == 'ok':
+            print(f"[   OK] baris {progress['line']} {progress['email']} ({progress['face']})")
+
+    # Tunggu foto referensi selesai ditulis sebelum proses keluar
+    shutdown_services()
+    print("-" * 50)
+    if summary.get('message'):
+        print(summary['message'])
+    print(f"{summary.get('inserted', 0)} user diimport, {summary.get('with_descriptors', 0)} dengan descriptor wajah, "
+          f"{summary.get('errors', 0)} error")
+    return 1 if summary.get('errors') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,32 +1,10 @@
-import sqlite3
+# Migrasi skema sekarang dijalankan otomatis oleh app.init_db() saat aplikasi start.
+# Script ini tetap ada untuk menjalankan migrasi secara manual tanpa menyalakan server.
+from app import init_db, db_connection
 
-# Koneksi ke database SQLite
-conn = sqlite3.connect('attendance.db')
-cur = conn.cursor()
+init_db()
 
-# Tambah kolom photo_profile
-try:
-    cur.execute("ALTER TABLE users ADD COLUMN photo_profile TEXT")
-    print("Kolom photo_profile ditambahkan.")
-except sqlite3.OperationalError:
-    print("Kolom photo_profile sudah ada.")
+with db_connection() as conn:
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
 
-# Tambah kolom photo_ref1
-try:
-    cur.execute("ALTER TABLE users ADD COLUMN photo_ref1 TEXT")
-    print("Kolom photo_ref1 ditambahkan.")
-except sqlite3.OperationalError:
-    print("Kolom photo_ref1 sudah ada.")
-
-# Tambah kolom photo_ref2
-try:
-    cur.execute("ALTER TABLE users ADD COLUMN photo_ref2 TEXT")
-    print("Kolom photo_ref2 ditambahkan.")
-except sqlite3.OperationalError:
-    print("Kolom photo_ref2 sudah ada.")
-
-# Simpan perubahan dan tutup koneksi
-conn.commit()
-conn.close()
-
-print("Update struktur database selesai.")
\ No newline at end of file
+print(f"Update struktur database selesai. Versi skema: {version}")